@@ -0,0 +1,129 @@
+import pickle
+import timeit
+import argparse
+
+import numpy as np
+
+from utils import *
+
+
+def gen_messages(user_num: int, size: int) -> list:
+    """Generates the messages of one round with realistic sizes, in both the pickled layout and the Wire layout.
+
+    Args:
+        user_num (int): the number of users.
+        size (int): the number of parameters of the gradients.
+
+    Returns:
+        list: the (name, pickled object, Wire type, Wire fields) tuples.
+    """
+
+    ids = [str(id) for id in range(1, user_num + 1)]
+    t = int(0.8 * user_num)
+
+    # every user has its own keys, shares and ciphertexts, so pickle cannot share repeated objects
+    def gen_keys():
+        return {"c_pk": get_random_bytes(256), "s_pk": get_random_bytes(256), "signature": get_random_bytes(128)}
+
+    keys = {id: gen_keys() for id in ids}       # DH group 14 and RSA-1024
+
+    s_pk, s_sk = KA.gen()
+    s_sk_shares = SS.share(s_sk, t, user_num)
+    random_seed_shares = SS.share(get_random_bytes(32), t, user_num)
+    share = Wire.dumps(Wire.SHARE, u="1", v="2", s_sk_share=s_sk_shares[1], random_seed_share=random_seed_shares[1])
+    ciphertexts = {id: get_random_bytes(len(share) + AE.tag_size) for id in ids[1:]}
+
+    masked_gradients = np.random.random(size)
+    verification_gradients = np.random.random(size)
+    # the float32 weights of a model in training
+    global_weights = [np.random.normal(0, 0.05, size).astype(np.float32), np.zeros(size // 100, dtype=np.float32)]
+
+    signatures = {id: keys[id]["signature"] for id in ids}
+    # 10% of the users drop out
+    priv_key_shares = {id: s_sk_shares[i] for i, id in enumerate(ids[:user_num // 10])}
+    random_seed_shares_map = {id: random_seed_shares[i] for i, id in enumerate(ids) if i >= user_num // 10}
+
+    return [
+        ("advertise keys", {"id": "1", **keys["1"]},
+         Wire.ADVERTISE_KEYS, {"id": "1", **keys["1"]}),
+        ("key map", keys,
+         Wire.KEY_MAP, {"keys": keys}),
+        ("share keys", ["1", ciphertexts],
+         Wire.SHARE_KEYS, {"id": "1", "ciphertexts": ciphertexts}),
+        ("masked input", ["1", masked_gradients, verification_gradients],
+         Wire.MASKED_INPUT, {"id": "1", "tensors": [masked_gradients, verification_gradients]}),
+        ("online users", ids,
+         Wire.ONLINE_USERS, {"ids": ids}),
+        ("signatures", signatures,
+         Wire.SIGNATURES, {"signatures": signatures}),
+        ("unmasking", ["1", priv_key_shares, random_seed_shares_map],
+         Wire.UNMASKING, {"id": "1", "priv_key_shares": priv_key_shares, "random_seed_shares": random_seed_shares_map}),
+        ("global weights", global_weights,
+         Wire.GLOBAL_WEIGHTS, {"version": 1, "base": 0, "tensors": global_weights})
+    ]
+
+
+def bench(fun, number: int) -> float:
+    # the best of 5 runs, in microseconds per call
+    return min(timeit.repeat(fun, number=number, repeat=5)) / number * 1e6
+
+
+def bench_schema(messages: list, number: int):
+    """Compares the Wire schema with pickle on the messages.
+    """
+
+    print("{:<16s}{:>12s}{:>12s}{:>14s}{:>14s}{:>14s}{:>14s}".format(
+        "message", "pickle B", "wire B", "pickle enc us", "wire enc us", "pickle dec us", "wire dec us"))
+
+    for name, obj, msg_type, fields in messages:
+        pickled = pickle.dumps(obj)
+        # a received message is a bytearray, see SocketUtil.recvall
+        encoded = bytearray(Wire.dumps(msg_type, **fields))
+
+        print("{:<16s}{:>12d}{:>12d}{:>14.1f}{:>14.1f}{:>14.1f}{:>14.1f}".format(
+            name, len(pickled), len(encoded),
+            bench(lambda: pickle.dumps(obj), number),
+            bench(lambda: Wire.encode(msg_type, **fields), number),
+            bench(lambda: pickle.loads(pickled), number),
+            bench(lambda: Wire.decode(encoded, msg_type), number)))
+
+
+def bench_compression(messages: list, number: int):
+    """Compares the codecs of Compression on the messages, with and without the 4-byte shuffle.
+    """
+
+    names = {Compression.ZLIB: "zlib", Compression.LZMA: "lzma", Compression.LZ4: "lz4"}
+
+    print("{:<16s}{:>12s}{:>8s}{:>10s}{:>12s}{:>14s}{:>14s}".format(
+        "message", "wire B", "codec", "shuffle", "ratio", "enc us", "dec us"))
+
+    for name, _, msg_type, fields in messages:
+        msg = Wire.encode(msg_type, **fields)
+        size = sum(memoryview(part).nbytes for part in msg)
+
+        for codec in Compression.available():
+            for shuffle in (1, 4):
+                compressed = Compression.encode(msg, codec, shuffle)
+
+                print("{:<16s}{:>12d}{:>8s}{:>10d}{:>12.3f}{:>14.1f}{:>14.1f}".format(
+                    name, size, names[codec], shuffle, len(compressed) / size,
+                    bench(lambda: Compression.encode(msg, codec, shuffle), number),
+                    bench(lambda: Compression.decompress(compressed), number)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares the Wire schema with pickle, or the codecs, on the messages of one round")
+    parser.add_argument("-u", "--user", type=int, default=100, help="the number of users")
+    parser.add_argument("-d", "--size", type=int, default=100000, help="the number of parameters")
+    parser.add_argument("-n", "--number", type=int, default=20, help="the number of calls per run")
+    parser.add_argument("-c", "--compression", action="store_true",
+                        help="compare the codecs of the compression instead, see Compression")
+
+    args = parser.parse_args()
+
+    messages = gen_messages(args.user, args.size)
+
+    if args.compression:
+        bench_compression(messages, args.number)
+    else:
+        bench_schema(messages, args.number)
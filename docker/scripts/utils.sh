@@ -18,9 +18,13 @@ Option:
   -i, --iteration int   Set the iteration of federated learning
   --model str           Set the trained model (MLP or CNN)
   --batchsize int       Set the training batch size
+  --sig str             Set the signature scheme (rsa or ed25519)
+  --ka str              Set the key agreement scheme (dh or x25519)
+  --mode str            Set the masking mode (float, int8, int16, int32 or int64)
+  --fanout int          Set the number of users each user relays the broadcasts to (0 for none)
 
 Examples:
-  start.sh -u 500 -t 300 -i 20 --model CNN --batchsize 28
+  start.sh -u 500 -t 300 -i 20 --model CNN --batchsize 28 --sig ed25519 --ka x25519 --mode int32
 EOF
 }
 
@@ -1,5 +1,5 @@
 import sys
-import time
+import pickle
 import logging
 import requests
 import tensorflow as tf
@@ -34,68 +34,60 @@ def create_model(name):
 
 
 def advertise_keys(server, user_num, t, wait_time):
-    cnt = 0
-    while len(SignatureRequestHandler.U_1) != user_num and cnt < wait_time:
-        time.sleep(1)
-        cnt += 1
+    SignatureRequestHandler.barrier.wait(user_num, wait_time)
 
     if len(SignatureRequestHandler.U_1) >= t:
-        U_1 = SignatureRequestHandler.U_1
+        U_1 = list(SignatureRequestHandler.U_1)
         SecretShareRequestHandler.U_1_num = len(U_1)
 
         logging.info("{} users have sent signatures".format(len(U_1)))
 
-        server.broadcast_signatures(server.broadcast_port)
+        failed = server.broadcast_signatures()
 
         logging.info("online users: " + ','.join(U_1))
+
+        # wait for the users to receive the keys
+        ReadyRequestHandler.barriers[Wire.phases[Wire.KEY_MAP]].wait(len(U_1) - len(failed), wait_time)
     else:
         logging.error("insufficient messages received by the server!")
 
         sys.exit(1)
 
-    time.sleep(1)
-
     print("{:=^80s}".format("Finish Advertising Keys"))
 
     return U_1
 
 
 def share_keys(server, U_1, t, wait_time):
-    cnt = 0
-    while len(SecretShareRequestHandler.U_2) != len(U_1) and cnt < wait_time:
-        time.sleep(1)
-        cnt += 1
+    SecretShareRequestHandler.barrier.wait(len(U_1), wait_time)
 
     if len(SecretShareRequestHandler.U_2) >= t:
-        U_2 = SecretShareRequestHandler.U_2
+        U_2 = list(SecretShareRequestHandler.U_2)
         MaskingRequestHandler.U_2_num = len(U_2)
 
         logging.info("{} users have sent ciphertexts".format(len(U_2)))
 
-        for u in U_2:
-            msg = pickle.dumps(SecretShareRequestHandler.ciphertexts_map[u])
-            server.send(msg, "user" + u, 10001)
+        failed = server.send_many({u: Wire.encode(Wire.CIPHERTEXTS, ciphertexts=SecretShareRequestHandler.ciphertexts_map[u])
+                                   for u in U_2})
+
+        # wait for the users to receive the ciphertexts
+        ReadyRequestHandler.barriers[Wire.phases[Wire.CIPHERTEXTS]].wait(len(U_2) - len(failed), wait_time)
     else:
         # the number of the received messages is less than the threshold value for SecretSharing, abort
         logging.error("insufficient ciphertexts received by the server!")
 
         sys.exit(1)
 
-    time.sleep(1)
-
     print("{:=^80s}".format("Finish Sharing Keys"))
 
     return U_2
 
 
 def masked_input_collection(U_2, t, wait_time):
-    cnt = 0
-    while len(MaskingRequestHandler.U_3) != len(U_2) and cnt < wait_time:
-        time.sleep(1)
-        cnt += 1
+    MaskingRequestHandler.barrier.wait(len(U_2), wait_time)
 
     if len(MaskingRequestHandler.U_3) >= t:
-        U_3 = MaskingRequestHandler.U_3
+        U_3 = list(MaskingRequestHandler.U_3)
         ConsistencyRequestHandler.U_3_num = len(U_3)
 
         logging.info("{} users have sent masked gradients".format(len(U_3)))
@@ -105,36 +97,28 @@ def masked_input_collection(U_2, t, wait_time):
 
         sys.exit(1)
 
-    time.sleep(1)
-
     print("{:=^80s}".format("Finish Masking Input"))
 
     return U_3
 
 
 def consistency_check(server, U_3, t, wait_time):
-    msg = pickle.dumps(U_3)
-    for u in U_3:
-        server.send(msg, "user" + u, 10001)
+    msg = Wire.encode(Wire.ONLINE_USERS, ids=U_3)
+    failed = server.send_many({u: msg for u in U_3})
 
-    time.sleep(0.2)
-
-    cnt = 0
-    while len(ConsistencyRequestHandler.U_4) != len(U_3) and cnt < wait_time:
-        time.sleep(1)
-        cnt += 1
+    ConsistencyRequestHandler.barrier.wait(len(U_3) - len(failed), wait_time)
 
     if len(ConsistencyRequestHandler.U_4) >= t:
-        U_4 = ConsistencyRequestHandler.U_4
+        U_4 = list(ConsistencyRequestHandler.U_4)
         UnmaskingRequestHandler.U_4_num = len(U_4)
 
         logging.info("{} users have sent consistency checks".format(len(U_4)))
 
-        for u in U_4:
-            msg = pickle.dumps(ConsistencyRequestHandler.consistency_check_map)
-            server.send(msg, "user" + u, 10001)
+        msg = Wire.encode(Wire.SIGNATURES, signatures=ConsistencyRequestHandler.consistency_check_map)
+        failed = server.send_many({u: msg for u in U_4})
 
-        time.sleep(10)
+        # wait for the users to verify the signatures, a failed user reports it at once
+        ReadyRequestHandler.barriers[Wire.phases[Wire.SIGNATURES]].wait(len(U_4) - len(failed), wait_time)
 
         if len(ConsistencyRequestHandler.status_list) != 0:
             # at least one user failed in consistency check
@@ -152,16 +136,13 @@ def consistency_check(server, U_3, t, wait_time):
         sys.exit(1)
 
 
-def unmasking(server, U_4, shapes, t, wait_time):
-    cnt = 0
-    while len(UnmaskingRequestHandler.U_5) != len(U_4) and cnt < wait_time:
-        time.sleep(1)
-        cnt += 1
+def unmasking(server, U_4, layout, t, wait_time):
+    UnmaskingRequestHandler.barrier.wait(len(U_4), wait_time)
 
     if len(UnmaskingRequestHandler.U_5) >= t:
         logging.info("{} users have sent shares".format(len(UnmaskingRequestHandler.U_5)))
 
-        output = server.unmask(shapes)
+        output = layout.unflatten(server.unmask(layout.size))
 
         print("{:=^80s}".format("Finish Unmasking"))
 
@@ -180,6 +161,10 @@ if __name__ == "__main__":
     wait_time = int(sys.argv[3])
     iteration = int(sys.argv[4])
     model_name = sys.argv[5]
+    ka_backend = sys.argv[6] if len(sys.argv) > 6 else "dh"
+    # the ring holds the sum of all users' gradients
+    fixed_point = FixedPoint.from_mode(sys.argv[7] if len(sys.argv) > 7 else "float", user_num)
+    fanout = int(sys.argv[8]) if len(sys.argv) > 8 else 0
 
     logging.basicConfig(
         level=logging.INFO,
@@ -191,9 +176,11 @@ if __name__ == "__main__":
     req = requests.get(dataset_url)
     dataset = pickle.loads(req.content)
 
-    server = Server()
+    server = Server(ka_backend, fixed_point, fanout)
 
     SignatureRequestHandler.user_num = user_num
+    MaskingRequestHandler.dtype = np.float64 if fixed_point is None else fixed_point.dtype
+    MaskingRequestHandler.ring_bits = fixed_point.ring_bits if fixed_point is not None and fixed_point.packed else None
     server.serve_all()
 
     model = create_model(model_name)
@@ -201,26 +188,29 @@ if __name__ == "__main__":
     model.compile(optimizer, loss='sparse_categorical_crossentropy', metrics='sparse_categorical_accuracy')
 
     global_weights = model.get_weights()
-    shapes = [g.shape for g in global_weights]
+    layout = ParamLayout.from_weights(global_weights)
+
+    # wait for all users to connect
+    server.session_server.connected.wait(user_num, wait_time)
+
+    logging.info("{} users have connected".format(len(server.session_server.connections)))
 
     for i in range(iteration):
-        # broadcast global weights
-        msg = pickle.dumps(global_weights)
-        for i in range(1, user_num + 1):
-            server.send(msg, "user" + str(i), 10001)
+        # broadcast global weights, as deltas from the versions the users have
+        failed = server.broadcast_weights(global_weights)
+        if len(failed) != 0:
+            logging.error("failed to send the global weights to users: " + ','.join(failed))
 
-        U_1 = advertise_keys(server, user_num, t, wait_time)
+        # the server does not wait for the users without the global weights
+        U_1 = advertise_keys(server, user_num - len(failed), t, wait_time)
 
         U_2 = share_keys(server, U_1, t, wait_time)
 
         U_3 = masked_input_collection(U_2, t, wait_time)
 
-        # wait for all users to listen to the server
-        time.sleep(60)
-
         U_4 = consistency_check(server, U_3, t, wait_time)
 
-        global_weights = unmasking(server, U_4, shapes, t, wait_time)
+        global_weights = unmasking(server, U_4, layout, t, wait_time)
 
         print("{:=^80s}".format("Finish Secure Aggregation"))
 
@@ -1,202 +1,669 @@
-import pickle
-import random
 import socket
+import asyncio
 import logging
-import socketserver
+import threading
+import multiprocessing
 import numpy as np
 
 from utils import *
+from concurrent.futures import Executor
 from threading import Thread
 
 # compatible with Windows
 socket.SO_REUSEPORT = socket.SO_REUSEADDR
 
 
-class SignatureRequestHandler(socketserver.BaseRequestHandler):
+def _recover_random_vecs(args: tuple) -> np.ndarray:
+    """Regenerates the random vectors between dropped users and online users, and sums them up.
+
+    Args:
+        args (tuple): the (u, priv_key, v, s_pk) pairs, the size of the flat gradients, the key agreement scheme
+                      and the dtype of the masks.
+
+    Returns:
+        np.ndarray: the partial sum of the signed random vectors p_u_v.
+    """
+
+    items, size, ka_backend, dtype = args
+
+    recon_random_vec = np.zeros(size, dtype)
+    for u, priv_key, v, v_s_pk in items:
+        shared_key = KA.agree(priv_key, v_s_pk, ka_backend)
+
+        PRG.accumulate(recon_random_vec, shared_key, subtract=int(u) < int(v))
+
+    return recon_random_vec
+
+
+def _decode(data, msg_type: int, id: str) -> dict:
+    """Decodes a message of the expected type sent by the user of a Connection, see Wire.
+
+    Returns:
+        dict: the fields of the message, or None if the message is malformed or claims another user's id.
+    """
+
+    try:
+        msg = Wire.decode(data, msg_type)
+    except ValueError as e:
+        logging.error("received a malformed message from user %s: %s", id, e)
+        return None
+
+    if msg["id"] != id:
+        logging.error("user %s sent a message as user %s", id, msg["id"])
+        return None
+
+    return msg
+
+
+class SignatureRequestHandler:
     user_num = 0
     ka_pub_keys_map = {}    # {id: {c_pk: bytes, s_pk, bytes, signature: bytes}}
     U_1 = []
+    barrier = PhaseBarrier()     # counts U_1
 
-    def handle(self) -> None:
-        # receive data from the client
-        data = SocketUtil.recv_msg(self.request)
+    @staticmethod
+    def handle(id: str, data) -> None:
+        msg = _decode(data, Wire.ADVERTISE_KEYS, id)
+        if msg is None:
+            return
 
-        msg = pickle.loads(data)
-        id = msg["id"]
         del msg["id"]
 
         SignatureRequestHandler.ka_pub_keys_map[id] = msg
         SignatureRequestHandler.U_1.append(id)
+        SignatureRequestHandler.barrier.arrive()
 
         received_num = len(SignatureRequestHandler.U_1)
 
         logging.info("[%d/%d] | received user %s's signature", received_num, SignatureRequestHandler.user_num, id)
 
 
-class SecretShareRequestHandler(socketserver.BaseRequestHandler):
+class SecretShareRequestHandler:
     U_1_num = 0
     ciphertexts_map = {}         # {u:{v1: ciphertexts, v2: ciphertexts}}
     U_2 = []
+    barrier = PhaseBarrier()     # counts U_2
 
-    def handle(self) -> None:
-        # receive data from the client
-        data = SocketUtil.recv_msg(self.request)
+    @staticmethod
+    def handle(id: str, data) -> None:
+        msg = _decode(data, Wire.SHARE_KEYS, id)
+        if msg is None:
+            return
 
-        msg = pickle.loads(data)
-        id = msg[0]
+        cls = SecretShareRequestHandler
 
         # retrieve each user's ciphertexts
-        for key, value in msg[1].items():
-            if key not in SecretShareRequestHandler.ciphertexts_map:
-                SecretShareRequestHandler.ciphertexts_map[key] = {}
-            SecretShareRequestHandler.ciphertexts_map[key][id] = value
+        for key, value in msg["ciphertexts"].items():
+            if key not in cls.ciphertexts_map:
+                cls.ciphertexts_map[key] = {}
+            cls.ciphertexts_map[key][id] = value
 
-        SecretShareRequestHandler.U_2.append(id)
+        cls.U_2.append(id)
+        cls.barrier.arrive()
 
-        received_num = len(SecretShareRequestHandler.U_2)
+        received_num = len(cls.U_2)
 
-        logging.info("[%d/%d] | received user %s's ciphertexts", received_num, SecretShareRequestHandler.U_1_num, id)
+        logging.info("[%d/%d] | received user %s's ciphertexts", received_num, cls.U_1_num, id)
 
 
-class MaskingRequestHandler(socketserver.BaseRequestHandler):
+class MaskingRequestHandler:
     U_2_num = 0
-    masked_gradients_list = []
+    dtype = np.float64      # the dtype of the masked gradients, see FixedPoint
+    ring_bits = None        # the bits per value of the packed gradients, None if they are not packed, see BitPacking
+    # the running sum of the received flat gradients, so the memory does not grow with the number of users
+    masked_gradients_sum = None
     U_3 = []
+    barrier = PhaseBarrier()     # counts U_3
+    lock = threading.Lock()
+
+    @staticmethod
+    def add(id: str, masked_gradients: np.ndarray, shape: tuple = None) -> bool:
+        """Folds a user's masked gradients into the running sum.
+
+        Args:
+            id (str): the id of the user.
+            masked_gradients (np.ndarray): the masked gradients, or their packed bytes.
+            shape (tuple, optional): the shape of the gradients packed in ring_bits bits per value, which are
+                                     unpacked straight into the sum, see BitPacking. Defaults to None for gradients
+                                     of dtype.
 
-    def handle(self) -> None:
-        # receive data from the client
-        data = SocketUtil.recv_msg(self.request)
+        Returns:
+            bool: False if the gradients are rejected, i.e. a duplicate or a mismatched dtype or shape.
+        """
+
+        cls = MaskingRequestHandler
+        packed = shape is not None
+
+        if not packed:
+            if masked_gradients.dtype != cls.dtype:
+                logging.error("user %s's masked gradients are %s, expected %s", id, masked_gradients.dtype,
+                              np.dtype(cls.dtype))
+                return False
+
+            shape = masked_gradients.shape
+        else:
+            size = BitPacking.size(int(np.prod(shape)), cls.ring_bits)
+            if masked_gradients.nbytes != size:
+                logging.error("user %s's packed gradients are %d bytes, expected %d", id, masked_gradients.nbytes,
+                              size)
+                return False
+
+        with cls.lock:
+            if id in cls.U_3:
+                logging.error("received user %s's masked gradients twice", id)
+                return False
+
+            if cls.masked_gradients_sum is None:
+                cls.masked_gradients_sum = np.zeros(shape, cls.dtype)
+            elif shape != cls.masked_gradients_sum.shape:
+                logging.error("user %s's masked gradients are %s, expected %s", id, shape,
+                              cls.masked_gradients_sum.shape)
+                return False
+
+            # the unsigned sums wrap around in Z_{2^k}
+            if packed:
+                BitPacking.accumulate(cls.masked_gradients_sum, masked_gradients, cls.ring_bits)
+            else:
+                cls.masked_gradients_sum += masked_gradients
 
-        msg = pickle.loads(data)
-        id = msg[0]
+            cls.U_3.append(id)
 
-        self.U_3.append(msg[0])
-        self.masked_gradients_list.append(msg[1])
+        return True
 
-        received_num = len(self.U_3)
+    @staticmethod
+    def handle(id: str, data) -> None:
+        # the tensors are views of the received buffer
+        msg = _decode(data, Wire.message_type(data), id)
+        if msg is None:
+            return
 
-        logging.info("[%d/%d] | received user %s's masked gradients", received_num, self.U_2_num, id)
+        shape = None
+        if "bits" in msg:
+            if msg["bits"] != MaskingRequestHandler.ring_bits:
+                logging.error("user %s's masked gradients are packed in %d bits, expected %s", id, msg["bits"],
+                              MaskingRequestHandler.ring_bits)
+                return
 
+            shape = tuple(msg["shape"])
 
-class ConsistencyRequestHandler(socketserver.BaseRequestHandler):
+        if len(msg["tensors"]) != 1 or not MaskingRequestHandler.add(id, msg["tensors"][0], shape):
+            return
+
+        MaskingRequestHandler.barrier.arrive()
+
+        received_num = len(MaskingRequestHandler.U_3)
+
+        logging.info("[%d/%d] | received user %s's masked gradients", received_num, MaskingRequestHandler.U_2_num, id)
+
+
+class ConsistencyRequestHandler:
     U_3_num = 0
     consistency_check_map = {}
     U_4 = []
+    barrier = PhaseBarrier()     # counts U_4
     status_list = []    # the ids of users who fails in consistency check
 
-    def handle(self) -> None:
-        data = SocketUtil.recv_msg(self.request)
-
-        msg = pickle.loads(data)
-
-        if len(msg) == 2:
-            id = msg[0]
+    @staticmethod
+    def handle(id: str, data) -> None:
+        msg = _decode(data, Wire.message_type(data), id)
+        if msg is None:
+            return
 
+        if "signature" in msg:
             ConsistencyRequestHandler.U_4.append(id)
-            ConsistencyRequestHandler.consistency_check_map[id] = msg[1]
+            ConsistencyRequestHandler.consistency_check_map[id] = msg["signature"]
+            ConsistencyRequestHandler.barrier.arrive()
 
             received_num = len(ConsistencyRequestHandler.U_4)
 
             logging.info("[%d/%d] | received user %s's consistency check",
                          received_num, ConsistencyRequestHandler.U_3_num, id)
         else:
-            ConsistencyRequestHandler.status_list.append(msg)
-            ConsistencyRequestHandler.U_4.append(msg)
+            ConsistencyRequestHandler.status_list.append(id)
+            ConsistencyRequestHandler.U_4.append(id)
 
-            logging.info("received user %s's wrong consistency check!", msg)
+            # the server does not wait for the failed user to be ready
+            ReadyRequestHandler.barriers[Wire.phases[Wire.SIGNATURES]].arrive()
 
+            logging.info("received user %s's wrong consistency check!", id)
 
-class UnmaskingRequestHandler(socketserver.BaseRequestHandler):
+
+class UnmaskingRequestHandler:
     U_4_num = 0
     priv_key_shares_map = {}        # {id: []}
     random_seed_shares_map = {}     # {id: []}
     U_5 = []
+    barrier = PhaseBarrier()     # counts U_5
 
-    def handle(self) -> None:
-        data = SocketUtil.recv_msg(self.request)
+    @staticmethod
+    def handle(id: str, data) -> None:
+        msg = _decode(data, Wire.UNMASKING, id)
+        if msg is None:
+            return
 
-        msg = pickle.loads(data)
-        id = msg[0]
+        cls = UnmaskingRequestHandler
 
         # retrieve the private key shares
-        for key, value in msg[1].items():
-            if key not in UnmaskingRequestHandler.priv_key_shares_map:
-                UnmaskingRequestHandler.priv_key_shares_map[key] = []
-            UnmaskingRequestHandler.priv_key_shares_map[key].append(value)
+        for key, value in msg["priv_key_shares"].items():
+            if key not in cls.priv_key_shares_map:
+                cls.priv_key_shares_map[key] = []
+            cls.priv_key_shares_map[key].append(value)
 
         # retrieve the ramdom seed shares
-        for key, value in msg[2].items():
-            if key not in UnmaskingRequestHandler.random_seed_shares_map:
-                UnmaskingRequestHandler.random_seed_shares_map[key] = []
-            UnmaskingRequestHandler.random_seed_shares_map[key].append(value)
+        for key, value in msg["random_seed_shares"].items():
+            if key not in cls.random_seed_shares_map:
+                cls.random_seed_shares_map[key] = []
+            cls.random_seed_shares_map[key].append(value)
+
+        cls.U_5.append(id)
+        cls.barrier.arrive()
+
+        received_num = len(cls.U_5)
+
+        logging.info("[%d/%d] | received user %s's shares", received_num, cls.U_4_num, id)
+
+
+class ReadyRequestHandler:
+    ready = {}      # {phase: [id]}, the users who have processed the server's message of each phase
+    # the barrier of each phase where the server waits for the users to process its message
+    barriers = {Wire.phases[Wire.KEY_MAP]: PhaseBarrier(),
+                Wire.phases[Wire.CIPHERTEXTS]: PhaseBarrier(),
+                Wire.phases[Wire.SIGNATURES]: PhaseBarrier()}
+
+    @staticmethod
+    def handle(id: str, data) -> None:
+        msg = _decode(data, Wire.READY, id)
+        if msg is None:
+            return
+
+        cls = ReadyRequestHandler
+
+        phase = msg["phase"]
+        if phase not in cls.barriers:
+            logging.error("user %s is ready for an unexpected phase %d", id, phase)
+            return
+
+        cls.ready.setdefault(phase, []).append(id)
+        cls.barriers[phase].arrive()
+
+
+class NackRequestHandler:
+    session = None      # the SessionServer resending the chunks
+    streams = {}        # {(phase, id): [chunk]}, the chunks of the messages disseminated to each user this round
+
+    @staticmethod
+    def handle(id: str, data) -> None:
+        msg = _decode(data, Wire.NACK, id)
+        if msg is None:
+            return
+
+        cls = NackRequestHandler
+
+        chunks = cls.streams.get((msg["phase"], id))
+        if chunks is None:
+            logging.error("user %s requested chunks of phase %d, which is not disseminated", id, msg["phase"])
+            return
+
+        # resend the missing chunks to the user itself
+        try:
+            for seq in msg["seqs"]:
+                if seq < len(chunks):
+                    cls.session.send(id, chunks[seq], phase=msg["phase"])
+        except OSError as e:
+            logging.error("failed to resend chunks to user %s: %s", id, e)
+            return
+
+        logging.info("resent %d chunks of phase %d to user %s", len(msg["seqs"]), msg["phase"], id)
+
+
+class WeightsAckRequestHandler:
+    versions = {}       # {id: version}, the version of the global weights each user has, kept across rounds
+
+    @staticmethod
+    def handle(id: str, data) -> None:
+        msg = _decode(data, Wire.WEIGHTS_ACK, id)
+        if msg is None:
+            return
+
+        WeightsAckRequestHandler.versions[id] = msg["version"]
+
+
+class SessionProtocol(asyncio.BufferedProtocol):
+    """Reads the frames of a user's Connection straight into preallocated buffers, see Connection.
+
+    Each frame is handled in the executor while reading is paused, so the frames of a user are handled in order
+    and at most one frame per user is buffered. A frame larger than SocketUtil.max_size, or than hello_size before
+    the user is identified, closes the connection before its buffer is allocated.
+    """
+
+    hello_size = 4096       # the maximum size of the HELLO message, the only frame of an unidentified connection
+
+    def __init__(self, session):
+        self.session = session
+        self.transport = None
+        self.id = None              # the id announced by the HELLO message
+        self.codecs = []            # the codecs the user can decompress, see Compression
+
+        self.header = bytearray(Connection.header.size)
+        self.buffer = self.header   # the header or the message being received
+        self.received = 0
+        self.round = 0
+        self.phase = 0
+
+        self.writable = asyncio.Event()     # cleared while the write buffer of the transport is full
+        self.writable.set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        return memoryview(self.buffer)[self.received:]
+
+    def buffer_updated(self, nbytes):
+        self.received += nbytes
+        if self.received < len(self.buffer):
+            return
+
+        if self.buffer is self.header:
+            size, self.round, self.phase = Connection.header.unpack(self.header)
+            if size > (SocketUtil.max_size if self.id is not None else SessionProtocol.hello_size):
+                logging.error("closed the connection of user %s sending a frame of %d bytes", self.id, size)
+                self.transport.close()
+                return
+
+            self.buffer = bytearray(size)
+            self.received = 0
+            if size > 0:
+                return
+
+        data = self.buffer
+        self.buffer = self.header
+        self.received = 0
+
+        self.transport.pause_reading()
+        self.session.loop.create_task(self.handle(self.round, self.phase, data))
+
+    async def handle(self, round: int, phase: int, data: bytearray):
+        try:
+            if self.id is None:
+                await self.hello(data)
+            else:
+                await self.session.dispatch(self.id, round, phase, data)
+        finally:
+            if not self.transport.is_closing():
+                self.transport.resume_reading()
+
+    async def hello(self, data: bytearray):
+        # the first message identifies the user
+        try:
+            msg = Wire.decode(data, Wire.HELLO)
+        except ValueError as e:
+            logging.error("received a malformed hello message: %s", e)
+            self.transport.close()
+            return
+
+        self.id = msg["id"]
+        self.codecs = [codec for codec in msg["codecs"] if codec in Compression.backends]
+
+        # a restarted user resumes from the round of the next global weights, which are sent to it in full, so the
+        # round is taken before the user can be among the recipients of the global weights
+        welcome = Wire.dumps(Wire.WELCOME, round=self.session.joining_round)
+        # a reconnected user has lost its global weights
+        WeightsAckRequestHandler.versions.pop(self.id, None)
+
+        self.session.connections[self.id] = self
+        self.session.connected.arrive()
+
+        logging.info("user %s connected", self.id)
+
+        try:
+            await self.send(0, Wire.phases[Wire.WELCOME], [welcome])
+        except OSError as e:
+            logging.error("failed to welcome user %s: %s", self.id, e)
+
+    def connection_lost(self, exc):
+        # wake up the waiting senders
+        self.writable.set()
+
+        if self.id is not None:
+            if self.session.connections.get(self.id) is self:
+                del self.session.connections[self.id]
+
+            logging.info("user %s disconnected", self.id)
+
+    def pause_writing(self):
+        self.writable.clear()
+
+    def resume_writing(self):
+        self.writable.set()
+
+    async def send(self, round: int, phase: int, parts: list):
+        if self.transport.is_closing():
+            raise ConnectionResetError("the connection is closed")
+
+        size = sum(memoryview(part).nbytes for part in parts)
+
+        # the parts of a frame are written without yielding, so frames are never interleaved
+        self.transport.write(Connection.header.pack(size, round, phase))
+        for part in parts:
+            self.transport.write(part)
+
+        await self.writable.wait()
+
+
+class SessionServer:
+    """Serves the Connections of all users on one port with a single asyncio event loop, and dispatches their
+    messages to the phase handlers.
+
+    The event loop only moves bytes, the handlers run in the executor, so a connection costs one SessionProtocol
+    instead of one thread. The methods except serve_forever are called from other threads.
+    """
+
+    # the handler of each message type sent by users
+    handlers = {
+        Wire.ADVERTISE_KEYS: SignatureRequestHandler,
+        Wire.SHARE_KEYS: SecretShareRequestHandler,
+        Wire.MASKED_INPUT: MaskingRequestHandler,
+        Wire.MASKED_PACKED: MaskingRequestHandler,
+        Wire.CONSISTENCY_CHECK: ConsistencyRequestHandler,
+        Wire.CONSISTENCY_FAILURE: ConsistencyRequestHandler,
+        Wire.READY: ReadyRequestHandler,
+        Wire.NACK: NackRequestHandler,
+        Wire.WEIGHTS_ACK: WeightsAckRequestHandler,
+        Wire.UNMASKING: UnmaskingRequestHandler
+    }
+
+    def __init__(self, host: str, port: int, backlog: int = 1024, executor: Executor = None):
+        """
+        Args:
+            host (str): the host to bind.
+            port (int): the port to bind.
+            backlog (int, optional): the size of the queue of pending connections. Defaults to 1024.
+            executor (Executor, optional): the executor running the handlers. Defaults to the loop's default
+                                           ThreadPoolExecutor.
+        """
+
+        self.executor = executor
+        self.round = 1              # the current round, messages tagged by other rounds are dropped
+        self.joining_round = 1      # the round of the next global weights, which connecting users join, see hello
+        self.connections = {}       # {id: SessionProtocol}, only modified by the event loop
+        self.connected = PhaseBarrier()     # counts the users who have connected
+
+        self.loop = asyncio.new_event_loop()
+        self.server = self.loop.run_until_complete(self.loop.create_server(
+            lambda: SessionProtocol(self), host, port, reuse_address=True, backlog=backlog))
+
+    def serve_forever(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    async def dispatch(self, id: str, round: int, phase: int, data: bytearray):
+        try:
+            msg_type = Wire.message_type(data)
+        except ValueError as e:
+            logging.error("received a malformed message from user %s: %s", id, e)
+            return
+
+        if round != self.round or msg_type not in self.handlers or phase != Wire.phases[msg_type]:
+            logging.error("dropped user %s's message of type %d tagged by round %d phase %d",
+                          id, msg_type, round, phase)
+            return
+
+        await self.loop.run_in_executor(self.executor, self.handlers[msg_type].handle, id, data)
 
-        UnmaskingRequestHandler.U_5.append(id)
+    async def __send(self, id: str, phase: int, parts: list):
+        connection = self.connections.get(id)
+        if connection is None:
+            raise ConnectionError("user {} is not connected".format(id))
 
-        received_num = len(UnmaskingRequestHandler.U_5)
+        await connection.send(self.round, phase, parts)
 
-        logging.info("[%d/%d] | received user %s's shares", received_num, UnmaskingRequestHandler.U_4_num, id)
+    def codecs(self, ids: list) -> list:
+        """Returns the codecs all the users can decompress, see Compression.
+        """
+
+        connections = [self.connections.get(id) for id in ids]
+
+        return [codec for codec in Compression.backends
+                if all(connection is not None and codec in connection.codecs for connection in connections)]
+
+    def send(self, id: str, msg, timeout: float = None, phase: int = None):
+        """Sends a message to a user, tagged by the current round and the phase of the message, and compressed for
+        the user's codecs, see Compression.
+
+        Args:
+            id (str): the id of the user.
+            msg (bytes or list): the message to be sent, or its parts, see Wire.encode.
+            timeout (float, optional): the maximum time to wait for the message to be buffered. Defaults to None.
+            phase (int, optional): the phase tag. Defaults to the phase of the message type, see Wire.phases.
+        """
+
+        parts = msg if isinstance(msg, list) else [msg]
+        if phase is None:
+            phase = Wire.phases[Wire.message_type(parts[0])]
+
+        msg = Compression.compress(parts, self.codecs([id]))
+        parts = msg if isinstance(msg, list) else [msg]
+
+        asyncio.run_coroutine_threadsafe(self.__send(id, phase, parts), self.loop).result(timeout)
+
+    async def __send_many(self, frames: dict, limit: int, timeout: float) -> list:
+        semaphore = asyncio.Semaphore(limit)
+
+        async def send(id, frames):
+            async with semaphore:
+                try:
+                    for phase, parts in frames:
+                        await asyncio.wait_for(self.__send(id, phase, parts), timeout)
+                except asyncio.TimeoutError:
+                    logging.error("timed out sending to user %s", id)
+                    return id
+                except OSError as e:
+                    logging.error("failed to send a message to user %s: %s", id, e)
+                    return id
+
+            return None
+
+        results = await asyncio.gather(*[send(id, frames) for id, frames in frames.items()])
+
+        return [id for id in results if id is not None]
+
+    def send_many(self, msgs: dict, phase: int = None, limit: int = 128, timeout: float = None) -> list:
+        """Sends messages to many users concurrently, at most limit users at once, so a slow user only delays its own
+        messages. A message sent to many users is compressed once for each set of codecs, see send.
+
+        Args:
+            msgs (dict): {id: [msg]}, the messages sent to each user in order, see send.
+            phase (int, optional): the phase tag. Defaults to the phase of each message type, see Wire.phases.
+            limit (int, optional): the maximum number of users being sent to at once. Defaults to 128.
+            timeout (float, optional): the maximum time to wait for each message of a user to be buffered.
+                                       Defaults to None.
+
+        Returns:
+            list: the ids of the users whose messages failed.
+        """
+
+        frames = {}         # {id: [(phase, parts)]}
+        compressed = {}     # {(message, codecs): message}
+        for u, msgs_of_user in msgs.items():
+            codecs = tuple(self.codecs([u]))
+            frames[u] = []
+            for msg in msgs_of_user:
+                parts = msg if isinstance(msg, list) else [msg]
+
+                key = (id(msg), codecs)
+                if key not in compressed:
+                    compressed[key] = Compression.compress(parts, codecs)
+                msg_parts = compressed[key] if isinstance(compressed[key], list) else [compressed[key]]
+
+                frames[u].append((phase if phase is not None else Wire.phases[Wire.message_type(parts[0])], msg_parts))
+
+        return asyncio.run_coroutine_threadsafe(self.__send_many(frames, limit, timeout), self.loop).result()
+
+    async def __close(self):
+        self.server.close()
+
+        for connection in list(self.connections.values()):
+            connection.transport.close()
+
+        await self.server.wait_closed()
+
+    def close(self):
+        """Closes the listening socket and all connections, and stops the event loop.
+        """
+
+        asyncio.run_coroutine_threadsafe(self.__close(), self.loop).result()
+
+        self.loop.call_soon_threadsafe(self.loop.stop)
 
 
 class Server:
-    def __init__(self):
+    def __init__(self, ka_backend="dh", fixed_point: FixedPoint = None, fanout: int = 0):
         self.id = "0"
+        self.ka_backend = ka_backend    # the key agreement scheme of the users' key pairs, see KA.backends
+        self.fixed_point = fixed_point  # the fixed-point masking mode, None for masking floats
+        self.fanout = fanout            # the fanout of the dissemination, 0 for sending to all users
+        self.send_limit = 128           # the maximum number of users being sent to at once, see send_many
+        self.send_timeout = 60          # the maximum time to wait for a user to take a message, see send_many
+        self.weights_version = 0        # the version of the last broadcasted global weights, see broadcast_weights
+        self.weights_history = {}       # {version: weights}, the versions the deltas are encoded from
+        self.weights_history_size = 4   # the number of versions kept
         self.host = socket.gethostname()
-        self.broadcast_port = 10000
-        self.signature_port = 20000
-        self.ss_port = 20001
-        self.masking_port = 20002
-        self.consistency_port = 20003
-        self.unmasking_port = 20004
-
-        socketserver.ThreadingTCPServer.allow_reuse_address = True
-        socketserver.ThreadingTCPServer.request_queue_size = 128    # The size of the request queue
-
-        self.signature_server = socketserver.ThreadingTCPServer(
-            ("0.0.0.0", self.signature_port), SignatureRequestHandler)
-        self.ss_server = socketserver.ThreadingTCPServer(
-            ("0.0.0.0", self.ss_port), SecretShareRequestHandler)
-        self.masking_server = socketserver.TCPServer(
-            ("0.0.0.0", self.masking_port), MaskingRequestHandler)
-        self.consistency_server = socketserver.ThreadingTCPServer(
-            ("0.0.0.0", self.consistency_port), ConsistencyRequestHandler)
-        self.unmasking_server = socketserver.ThreadingTCPServer(
-            ("0.0.0.0", self.unmasking_port), UnmaskingRequestHandler)
+        self.port = 20000       # the port of the users' Connections
+
+        self.session_server = SessionServer("0.0.0.0", self.port)
+        NackRequestHandler.session = self.session_server
 
     def serve_all(self):
-        signature_thread = Thread(target=self.signature_server.serve_forever)
-        ss_thread = Thread(target=self.ss_server.serve_forever)
-        masking_thread = Thread(target=self.masking_server.serve_forever)
-        consistency_thread = Thread(target=self.consistency_server.serve_forever)
-        unmasking_thread = Thread(target=self.unmasking_server.serve_forever)
-
-        signature_thread.daemon = True
-        signature_thread.start()
-        ss_thread.daemon = True
-        ss_thread.start()
-        masking_thread.daemon = True
-        masking_thread.start()
-        consistency_thread.daemon = True
-        consistency_thread.start()
-        unmasking_thread.daemon = True
-        unmasking_thread.start()
+        session_thread = Thread(target=self.session_server.serve_forever)
+
+        session_thread.daemon = True
+        session_thread.start()
 
         logging.info("start all servers")
 
     def close_all(self):
-        self.signature_server.server_close()
-        self.ss_server.server_close()
-        self.masking_server.server_close()
-        self.consistency_server.server_close()
-        self.unmasking_server.server_close()
+        self.session_server.close()
 
         logging.info("stop all servers")
 
     def clean(self):
+        # the connections are kept, only the messages of the next round are accepted
+        self.session_server.round += 1
+
+        for handler in [SignatureRequestHandler, SecretShareRequestHandler, MaskingRequestHandler,
+                        ConsistencyRequestHandler, UnmaskingRequestHandler]:
+            handler.barrier.reset()
+        ReadyRequestHandler.ready = {}
+        for barrier in ReadyRequestHandler.barriers.values():
+            barrier.reset()
+        NackRequestHandler.streams = {}
+
         SignatureRequestHandler.ka_pub_keys_map = {}
         SignatureRequestHandler.U_1 = []
         SecretShareRequestHandler.ciphertexts_map = {}
         SecretShareRequestHandler.U_2 = []
-        MaskingRequestHandler.masked_gradients_list = []
+        MaskingRequestHandler.masked_gradients_sum = None
         MaskingRequestHandler.U_3 = []
         ConsistencyRequestHandler.consistency_check_map = {}
         ConsistencyRequestHandler.U_4 = []
@@ -205,96 +672,176 @@ class Server:
         UnmaskingRequestHandler.random_seed_shares_map = {}
         UnmaskingRequestHandler.U_5 = []
 
-    def broadcast_signatures(self, port: int):
-        """Broadcasts all users' key pairs and corresponding signatures.
+    def broadcast_weights(self, weights: list) -> list:
+        """Disseminates a new version of the global weights to all connected users. A user who has acknowledged a
+        version still in weights_history receives the delta from it, and any other user the full weights, see Delta.
 
         Args:
-            port (int): the port used to broadcast the message.
+            weights (list): the weights of the global model.
+
+        Returns:
+            list: the ids of the users who cannot be sent to, see send_many.
         """
 
-        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.weights_version += 1
+
+        # the users connecting from now on wait for the global weights of the next round
+        self.session_server.joining_round = self.session_server.round + 1
+
+        # the users of each base version receive the same message
+        users = sorted(self.session_server.connections, key=int)
+        deltas = {0: weights}
+        for base in set(WeightsAckRequestHandler.versions.get(u, 0) for u in users) & set(self.weights_history):
+            try:
+                deltas[base] = Delta.encode(weights, self.weights_history[base])
+            except ValueError:
+                logging.warning("global weights of version %d do not match version %d", self.weights_version, base)
+
+        groups = {}
+        for u in users:
+            base = WeightsAckRequestHandler.versions.get(u, 0)
+            groups.setdefault(base if base in deltas else 0, []).append(u)
+
+        failed = []
+        for base, ids in groups.items():
+            msg = Wire.encode(Wire.GLOBAL_WEIGHTS, version=self.weights_version, base=base, tensors=deltas[base])
+
+            failed += self.disseminate(msg, ids)
 
-        # reuse port so we will be able to run multiple clients on single (host, port).
-        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            logging.info("broadcasted global weights of version %d from version %d to %d users",
+                         self.weights_version, base, len(ids))
 
-        # enable broadcasting mode
-        server.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.weights_history[self.weights_version] = weights
+        self.weights_history.pop(self.weights_version - self.weights_history_size, None)
 
-        data = pickle.dumps(SignatureRequestHandler.ka_pub_keys_map)
+        return failed
 
-        SocketUtil.broadcast_msg(server, data, port)
+    def broadcast_signatures(self) -> list:
+        """Disseminates all users' key pairs and corresponding signatures to the users in U_1.
+
+        Returns:
+            list: the ids of the users who cannot be sent to, see send_many.
+        """
+
+        msg = Wire.dumps(Wire.KEY_MAP, keys=SignatureRequestHandler.ka_pub_keys_map)
+
+        failed = self.disseminate(msg, list(SignatureRequestHandler.U_1))
 
         logging.info("broadcasted all signatures.")
 
-        server.close()
+        return failed
+
+    def disseminate(self, msg, ids: list) -> list:
+        """Sends a message to many users in chunks, which are relayed by the users in a tree, see Dissemination.
+
+        Args:
+            msg (bytes or list): the message to be sent, or its parts, see Wire.encode.
+            ids (list): the ids of the recipients.
+
+        Returns:
+            list: the ids of the users who cannot be sent to, see send_many.
+        """
+
+        phase = Wire.phases[Wire.message_type(msg[0] if isinstance(msg, list) else msg)]
+
+        # the chunks are relayed as they are, so the message is compressed for the codecs of all the recipients
+        msg = Compression.compress(msg, self.session_server.codecs(ids))
+        header, chunks = Dissemination.split(msg, ids, self.fanout)
 
-    def send(self, msg: bytes, host: str, port: int):
-        """Sends message to host:port.
+        # keep the chunks for the NACKs of this round, by recipient, as users may be sent different messages of a phase
+        for u in ids:
+            NackRequestHandler.streams[(phase, u)] = chunks
+
+        msgs = {u: [header] for u in ids}
+        for u in Dissemination.children(ids, None, self.fanout):
+            msgs[u] += chunks
+
+        # the users missing chunks repair them with NACKs
+        return self.session_server.send_many(msgs, phase, self.send_limit, self.send_timeout)
+
+    def send_many(self, msgs: dict, phase: int = None) -> list:
+        """Sends messages to many users concurrently, see SessionServer.send_many.
 
         Args:
-            msg (bytes): the message to be sent.
-            host (str): the target host.
-            port (int): the target port.
+            msgs (dict): {id: msg}, the message sent to each user, see send.
+            phase (int, optional): the phase tag. Defaults to the phase of each message type, see Wire.phases.
+
+        Returns:
+            list: the ids of the users who cannot be sent to in send_timeout seconds.
         """
 
-        sock = socket.socket()
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
-        sock.connect((host, port))
+        return self.session_server.send_many({id: [msg] for id, msg in msgs.items()}, phase, self.send_limit,
+                                             self.send_timeout)
+
+    def send(self, msg, id: str, phase: int = None) -> bool:
+        """Sends a message to a user over its Connection, tagged by the current round and the phase of the message.
+
+        Args:
+            msg (bytes or list): the message to be sent, or its parts, see Wire.encode.
+            id (str): the id of the user.
+            phase (int, optional): the phase tag. Defaults to the phase of the message type, see Wire.phases.
+
+        Returns:
+            bool: False if the user is not connected or the connection fails.
+        """
 
-        SocketUtil.send_msg(sock, msg)
+        try:
+            self.session_server.send(id, msg, phase=phase)
+        except OSError as e:
+            logging.error("failed to send a message to user %s: %s", id, e)
+            return False
 
-        sock.close()
+        return True
 
-    def unmask(self, shapes: list) -> np.ndarray:
+    def unmask(self, size: int, processes: int = None) -> np.ndarray:
         """Unmasks gradients by reconstructing random vectors and private mask vectors.
+        With a fixed-point masking mode, the sum is unmasked in Z_{2^k} and decoded before averaging.
 
         Args:
-            shapes (list): the shapes of the raw gradients.
+            size (int): the size of the flat gradients, see ParamLayout.
+            processes (int, optional): the number of processes recovering the dropped users' random vectors.
+                                       Defaults to the number of CPUs.
 
         Returns:
-            np.ndarray: the sum of the raw gradients.
+            np.ndarray: the average of the flat raw gradients.
         """
 
+        dtype = np.float64 if self.fixed_point is None else self.fixed_point.dtype
+
         # reconstruct random vectors p_v_u
-        recon_random_vec_list = []
-        for u in SecretShareRequestHandler.U_2:
-            if u not in MaskingRequestHandler.U_3:
-                # the user drops out, reconstruct its private keys and then generate the corresponding random vectors
-                priv_key = SS.recon(UnmaskingRequestHandler.priv_key_shares_map[u])
-                for v in MaskingRequestHandler.U_3:
-                    shared_key = KA.agree(priv_key, SignatureRequestHandler.ka_pub_keys_map[v]["s_pk"])
-
-                    if int(u) > int(v):
-                        recon_random_vec = []
-                        for shape in shapes:
-                            random.seed(shared_key)
-                            rs = np.random.RandomState(random.randint(0, 2**32 - 1))
-                            recon_random_vec.append(rs.random(shape))
-                        recon_random_vec_list.append(recon_random_vec)
-                    else:
-                        recon_random_vec = []
-                        for shape in shapes:
-                            random.seed(shared_key)
-                            rs = np.random.RandomState(random.randint(0, 2**32 - 1))
-                            recon_random_vec.append(-rs.random(shape))
-                        recon_random_vec_list.append(recon_random_vec)
-
-        # reconstruct private mask vectors p_u
-        recon_priv_vec_list = []
-        for u in MaskingRequestHandler.U_3:
-            priv_mask_vec = []
-            for shape in shapes:
-                random_seed = SS.recon(UnmaskingRequestHandler.random_seed_shares_map[u])
-                rs = np.random.RandomState(random_seed)
-                priv_mask_vec.append(rs.random(shape))
-
-            recon_priv_vec_list.append(priv_mask_vec)
-
-        masked_gradients = np.sum(MaskingRequestHandler.masked_gradients_list, axis=0)
-        num = len(MaskingRequestHandler.masked_gradients_list)
-        recon_priv_vec_sum = np.sum(recon_priv_vec_list, axis=0)
-        recon_random_vec_sum = np.sum(recon_random_vec_list, axis=0)
-
-        output = np.sum([masked_gradients, -recon_priv_vec_sum, recon_random_vec_sum], axis=0) / num
-
-        return output
+        items = []      # [(u, priv_key, v, s_pk)]
+        # the users drop out, reconstruct their private keys and then generate the corresponding random vectors
+        dropped_users = [u for u in SecretShareRequestHandler.U_2 if u not in MaskingRequestHandler.U_3]
+        priv_keys = SS.recon_many([UnmaskingRequestHandler.priv_key_shares_map[u] for u in dropped_users])
+        for u, priv_key in zip(dropped_users, priv_keys):
+            for v in MaskingRequestHandler.U_3:
+                items.append((u, priv_key, v, SignatureRequestHandler.ka_pub_keys_map[v]["s_pk"]))
+
+        # accumulate every reconstructed vector into the output buffer as soon as it is available,
+        # so the memory does not grow with the number of users
+        output = MaskingRequestHandler.masked_gradients_sum.copy()
+
+        if len(items) > 0:
+            if processes is None:
+                processes = multiprocessing.cpu_count()
+
+            # each worker reduces its own chunk of (u, v) pairs, so only one partial sum per chunk is sent back
+            chunk_size = -(-len(items) // processes)
+            tasks = [(items[i:i + chunk_size], size, self.ka_backend, dtype) for i in range(0, len(items), chunk_size)]
+
+            # the workers are started by a forkserver, since forking the threads of the server could copy a held lock
+            with multiprocessing.get_context("forkserver").Pool(min(processes, len(tasks))) as pool:
+                for recon_random_vec in pool.imap_unordered(_recover_random_vecs, tasks):
+                    output += recon_random_vec
+
+        # remove private mask vectors p_u
+        random_seeds = SS.recon_many([UnmaskingRequestHandler.random_seed_shares_map[u]
+                                      for u in MaskingRequestHandler.U_3])
+        for random_seed in random_seeds:
+            PRG.accumulate(output, random_seed, subtract=True)
+
+        # the unsigned sum wraps around in Z_{2^k}, so decode it before averaging
+        if self.fixed_point is not None:
+            output = self.fixed_point.decode(output)
+
+        return output / len(MaskingRequestHandler.U_3)
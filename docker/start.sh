@@ -30,6 +30,10 @@ WAIT_TIME=100
 ITERATION=10
 MODEL="MLP"
 BATCH_SIZE=28
+SIG_BACKEND="rsa"
+KA_BACKEND="dh"
+MODE="float"
+FANOUT=0
 
 # parse command-line args
 if [[ $# -lt 1 ]]; then
@@ -69,6 +73,40 @@ else
             BATCH_SIZE=$2
             shift
             ;;
+        --sig)
+            SIG_BACKEND=$2 # the signature scheme distributed by the TA
+
+            if [[ $SIG_BACKEND != "rsa" && $SIG_BACKEND != "ed25519" ]]; then
+                errorln "Invalid signature scheme, rsa or ed25519 are supported!"
+                exit 1
+            fi
+
+            shift
+            ;;
+        --ka)
+            KA_BACKEND=$2 # the key agreement scheme of the users and the server
+
+            if [[ $KA_BACKEND != "dh" && $KA_BACKEND != "x25519" ]]; then
+                errorln "Invalid key agreement scheme, dh or x25519 are supported!"
+                exit 1
+            fi
+
+            shift
+            ;;
+        --mode)
+            MODE=$2 # the masking mode of the users and the server
+
+            if [[ $MODE != "float" && $MODE != "int8" && $MODE != "int16" && $MODE != "int32" && $MODE != "int64" ]]; then
+                errorln "Invalid masking mode, float, int8, int16, int32 or int64 are supported!"
+                exit 1
+            fi
+
+            shift
+            ;;
+        --fanout)
+            FANOUT=$2 # the fanout of the users relaying the broadcasts of the server
+            shift
+            ;;
         *)
             errorln "Unknown flag: $key"
             printHelp
@@ -88,7 +126,7 @@ clean
 docker network create sa
 successln "Successfully created sa network"
 infoln "Creating TA"
-docker run -d --name ta -h ta --network sa sa/ta:1.0 python -u main.py $USER_NUM $MODEL
+docker run -d --name ta -h ta -v $PWD/keys:/ta/keys --network sa sa/ta:1.0 python -u main.py $USER_NUM $MODEL $SIG_BACKEND
 # wait for preparing dataset and keys
 while [[ $(docker logs ta 2>&1 | grep "Running on" | wc -l) -eq 0 ]]; do
     sleep 1
@@ -97,11 +135,11 @@ successln "Successfully created TA"
 
 infoln "Creating $USER_NUM users"
 for i in $user_ids; do
-    docker run -d --gpus all --name user"$i" -h user"$i" --network sa sa/user:1.0 python -u main.py $i $t $ITERATION $MODEL $BATCH_SIZE
+    docker run -d --gpus all --name user"$i" -h user"$i" --network sa sa/user:1.0 python -u main.py $i $t $ITERATION $MODEL $BATCH_SIZE $KA_BACKEND $MODE
 done
 successln "Successfully created $USER_NUM users"
 infoln "Creating server"
 
-docker run -d --name server -h server -v $PWD/server:/server --network sa sa/server:1.0 $USER_NUM $t $WAIT_TIME $ITERATION $MODEL
+docker run -d --name server -h server -v $PWD/server:/server --network sa sa/server:1.0 $USER_NUM $t $WAIT_TIME $ITERATION $MODEL $KA_BACKEND $MODE $FANOUT
 successln "Successfully created server"
 sleep 5
@@ -1,69 +1,29 @@
-import os
 import sys
-import rsa
 import pickle
 import socket
-import multiprocessing
 import numpy as np
 import tensorflow as tf
 
 from flask import Flask, request
+from utils import KeyStore
 
 
-class SIG:
-    """Generates public and private keys, signs and verifies the message.
-    """
-
-    @staticmethod
-    def gen(path: str = None, nbits=1024) -> tuple:
-        """Generates public and private keys using RSA algorithm, and saves them.
-
-        Args:
-            path (str): path to store the public and private keys.
-            nbits (int, optional): the number of bit used in RSA. Defaults to 1024.
-
-        Returns:
-            Tuple[PublicKey, PrivateKey]: the public and private keys.
-        """
-
-        pub_key, priv_key = rsa.newkeys(nbits, poolsize=multiprocessing.cpu_count())
-
-        if path is not None:
-            os.makedirs(path)
-
-            # save the pub_key and priv_key
-            with open(os.path.join(path, "pub.pem"), 'wb') as f:
-                f.write(pub_key.save_pkcs1())
-            with open(os.path.join(path, "priv.pem"), 'wb') as f:
-                f.write(priv_key.save_pkcs1())
-
-        return pub_key, priv_key
-
-    @staticmethod
-    def sign(msg: bytes, priv_key, hash_method="SHA-1"):
-        return rsa.sign(msg, priv_key, hash_method)
-
-    @staticmethod
-    def verify(msg: bytes, signature: bytes, pub_key) -> bool:
-        try:
-            rsa.verify(msg, signature, pub_key)
-
-            return True
+def generate_keys():
+    """Generates the missing keys of all users, and loads all users' public keys.
 
-        except rsa.VerificationError:
-            return False
+    Returns:
+        dict: all users' public keys.
+    """
 
+    for _ in keystore.generate(user_ids):
+        pass
 
-def generate_keys():
     pub_key_map = {}    # the dict storing all users' public keys
-    priv_key_map = {}    # the dict storing all users' private keys
 
     for id in user_ids:
-        pub_key, priv_key = SIG.gen(nbits=1024)
-        pub_key_map[id] = pub_key
-        priv_key_map[id] = priv_key
+        pub_key_map[id] = keystore.pub_key(id)
 
-    return pub_key_map, priv_key_map
+    return pub_key_map
 
 
 def generate_dataset(shape=(784,)) -> dict:
@@ -111,8 +71,9 @@ def get_pub_key():
     id = host.split('.')[0][4:]
 
     data = {
+        "sigBackend": sig_backend,
         "pubKeyMap": pub_key_map,
-        "privKey": priv_key_map[id]
+        "privKey": keystore.priv_key(id)
     }
 
     return pickle.dumps(data)
@@ -134,12 +95,15 @@ def get_model():
 if __name__ == "__main__":
     user_ids = [str(id) for id in range(1, int(sys.argv[1]) + 1)]
     model_name = sys.argv[2]
+    sig_backend = sys.argv[3] if len(sys.argv) > 3 else "rsa"
 
     if model_name == "CNN":
         dataset = generate_dataset((28, 28, 1))
     else:
         dataset = generate_dataset()
 
-    pub_key_map, priv_key_map = generate_keys()
+    # the keys are persisted under ./keys, so a restarted TA loads them instead of regenerating them
+    keystore = KeyStore("keys", nbits=1024, backend=sig_backend)
+    pub_key_map = generate_keys()
 
     app.run(host="0.0.0.0")
@@ -0,0 +1,1841 @@
+import os
+import rsa
+import time
+import zlib
+import lzma
+import queue
+import socket
+import struct
+import secrets
+import logging
+import functools
+import threading
+import multiprocessing
+import numpy as np
+
+from Cryptodome.Cipher import AES
+from Cryptodome.Hash import SHA256
+from Cryptodome.PublicKey import ECC
+from Cryptodome.Signature import eddsa
+from Cryptodome.Random import get_random_bytes
+from diffiehellman import DiffieHellman
+from diffiehellman.primes import PRIMES
+
+try:
+    import lz4.frame
+except ImportError:     # the optional fast codec, see Compression
+    lz4 = None
+
+
+class RSASignature:
+    """RSA signature backend using the rsa package (PKCS#1 v1.5).
+    """
+
+    @staticmethod
+    def gen(path: str = None, nbits=1024, poolsize: int = None) -> tuple:
+        """Generates public and private keys using RSA algorithm, and saves them.
+
+        Args:
+            path (str): path to store the public and private keys.
+            nbits (int, optional): the number of bit used in RSA. Defaults to 1024.
+            poolsize (int, optional): the number of processes used to find the primes. Defaults to the number of CPUs.
+
+        Returns:
+            Tuple[PublicKey, PrivateKey]: the public and private keys.
+        """
+
+        if poolsize is None:
+            poolsize = multiprocessing.cpu_count()
+
+        pub_key, priv_key = rsa.newkeys(nbits, poolsize=poolsize)
+
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+            # save the pub_key and priv_key
+            with open(os.path.join(path, "pub.pem"), 'wb') as f:
+                f.write(pub_key.save_pkcs1())
+            with open(os.path.join(path, "priv.pem"), 'wb') as f:
+                f.write(priv_key.save_pkcs1())
+
+        return pub_key, priv_key
+
+    @staticmethod
+    def load_pub_key(path: str):
+        with open(os.path.join(path, "pub.pem"), 'rb') as f:
+            return rsa.PublicKey.load_pkcs1(f.read())
+
+    @staticmethod
+    def load_priv_key(path: str):
+        with open(os.path.join(path, "priv.pem"), 'rb') as f:
+            return rsa.PrivateKey.load_pkcs1(f.read())
+
+    @staticmethod
+    def sign(msg: bytes, priv_key, hash_method="SHA-1"):
+        # rsa only hashes bytes, while received messages are bytearrays
+        return rsa.sign(bytes(msg), priv_key, hash_method)
+
+    @staticmethod
+    def verify(msg: bytes, signature: bytes, pub_key) -> bool:
+        try:
+            rsa.verify(bytes(msg), bytes(signature), pub_key)
+
+            return True
+
+        except rsa.VerificationError:
+            return False
+
+
+@functools.lru_cache(maxsize=4096)
+def _import_ed25519_pub_key(pub_key: bytes):
+    return eddsa.import_public_key(pub_key)
+
+
+@functools.lru_cache(maxsize=64)
+def _import_ed25519_priv_key(priv_key: bytes):
+    return ECC.construct(curve="Ed25519", seed=priv_key)
+
+
+class Ed25519Signature:
+    """Ed25519 signature backend (RFC 8032) using pycryptodomex.
+
+    The keys are raw bytes (32-byte public key and 32-byte seed), so they can be pickled and sent like RSA keys.
+    """
+
+    @staticmethod
+    def gen(path: str = None, nbits=None, poolsize: int = None) -> tuple:
+        """Generates public and private keys using Ed25519 algorithm, and saves them.
+
+        Args:
+            path (str): path to store the public and private keys.
+            nbits (int, optional): unused, the key size of Ed25519 is fixed.
+            poolsize (int, optional): unused, the key generation is cheap.
+
+        Returns:
+            Tuple[bytes, bytes]: the public and private keys.
+        """
+
+        key = ECC.generate(curve="Ed25519")
+        pub_key, priv_key = key.public_key().export_key(format="raw"), key.seed
+
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+            # save the pub_key and priv_key
+            with open(os.path.join(path, "pub.pem"), 'wt') as f:
+                f.write(key.public_key().export_key(format="PEM"))
+            with open(os.path.join(path, "priv.pem"), 'wt') as f:
+                f.write(key.export_key(format="PEM"))
+
+        return pub_key, priv_key
+
+    @staticmethod
+    def load_pub_key(path: str) -> bytes:
+        with open(os.path.join(path, "pub.pem"), 'rt') as f:
+            return ECC.import_key(f.read()).export_key(format="raw")
+
+    @staticmethod
+    def load_priv_key(path: str) -> bytes:
+        with open(os.path.join(path, "priv.pem"), 'rt') as f:
+            return ECC.import_key(f.read()).seed
+
+    @staticmethod
+    def sign(msg: bytes, priv_key: bytes) -> bytes:
+        signer = eddsa.new(_import_ed25519_priv_key(priv_key), "rfc8032")
+
+        return signer.sign(msg)
+
+    @staticmethod
+    def verify(msg: bytes, signature: bytes, pub_key: bytes) -> bool:
+        try:
+            verifier = eddsa.new(_import_ed25519_pub_key(pub_key), "rfc8032")
+            verifier.verify(msg, signature)
+
+            return True
+
+        except ValueError:
+            return False
+
+
+def _verify_chunk(args: tuple) -> list:
+    entries, backend = args
+
+    return [SIG.verify(msg, signature, pub_key, backend) for msg, signature, pub_key in entries]
+
+
+class SIG:
+    """Generates public and private keys, signs and verifies the message.
+
+    The signature scheme is selected by the backend argument, which is one of the keys of SIG.backends.
+    """
+
+    backends = {
+        "rsa": RSASignature,
+        "ed25519": Ed25519Signature
+    }
+
+    # the process pool shared by all verify_many calls, created on the first use. Its workers are started by a
+    # forkserver, since forking the threads of the Connections and handlers could copy a lock held by one of them.
+    pool = None
+    pool_lock = threading.Lock()
+
+    @staticmethod
+    def backend(name: str):
+        if name not in SIG.backends:
+            raise ValueError("Invalid signature backend: {}".format(name))
+
+        return SIG.backends[name]
+
+    @staticmethod
+    def gen(path: str = None, nbits=1024, poolsize: int = None, backend="rsa") -> tuple:
+        return SIG.backend(backend).gen(path, nbits, poolsize)
+
+    @staticmethod
+    def load_pub_key(path: str, backend="rsa"):
+        return SIG.backend(backend).load_pub_key(path)
+
+    @staticmethod
+    def load_priv_key(path: str, backend="rsa"):
+        return SIG.backend(backend).load_priv_key(path)
+
+    @staticmethod
+    def sign(msg: bytes, priv_key, backend="rsa") -> bytes:
+        return SIG.backend(backend).sign(msg, priv_key)
+
+    @staticmethod
+    def verify(msg: bytes, signature: bytes, pub_key, backend="rsa") -> bool:
+        return SIG.backend(backend).verify(msg, signature, pub_key)
+
+    @staticmethod
+    def verify_many(entries: list, backend="rsa", chunksize=64) -> list:
+        """Verifies many signatures in chunks across a process pool, so that the verification scales with cores.
+
+        Args:
+            entries (list): the (msg, signature, pub_key) tuples to be verified.
+            backend (str, optional): the signature scheme. Defaults to "rsa".
+            chunksize (int, optional): the number of signatures verified by one task. Defaults to 64.
+
+        Returns:
+            list: the verification result of each entry.
+        """
+
+        if len(entries) <= chunksize:
+            # not worth the inter-process communication
+            return _verify_chunk((entries, backend))
+
+        with SIG.pool_lock:
+            if SIG.pool is None:
+                SIG.pool = multiprocessing.get_context("forkserver").Pool()
+
+        tasks = [(entries[i:i + chunksize], backend) for i in range(0, len(entries), chunksize)]
+
+        results = []
+        for chunk_results in SIG.pool.map(_verify_chunk, tasks):
+            results.extend(chunk_results)
+
+        return results
+
+
+def _gen_keys(args: tuple) -> str:
+    path, id, nbits, backend = args
+
+    # each worker is already one process of the pool, so the primes are searched serially
+    SIG.gen(os.path.join(path, id), nbits, poolsize=1, backend=backend)
+
+    return id
+
+
+class KeyStore:
+    """Generates users' signature keys across a process pool, persists them and loads them lazily.
+
+    The keys of user id are stored in path/backend/id/pub.pem and path/backend/id/priv.pem, so repeated
+    simulations and TA restarts reuse the existing keys instead of regenerating them.
+    """
+
+    def __init__(self, path: str, nbits=1024, backend="rsa"):
+        SIG.backend(backend)
+
+        self.path = os.path.join(path, backend)
+        self.nbits = nbits
+        self.backend = backend
+
+        self.__pub_keys = {}     # {id: PublicKey}
+        self.__priv_keys = {}    # {id: PrivateKey}
+
+    def exists(self, id: str) -> bool:
+        key_path = os.path.join(self.path, id)
+
+        return os.path.isfile(os.path.join(key_path, "pub.pem")) and os.path.isfile(os.path.join(key_path, "priv.pem"))
+
+    def generate(self, ids: list, processes: int = None):
+        """Generates the keys of the users who do not have keys in the keystore yet.
+
+        Args:
+            ids (list): the ids of all users.
+            processes (int, optional): the number of worker processes. Defaults to the number of CPUs.
+
+        Yields:
+            str: the id of each user whose keys are available.
+        """
+
+        missing_ids = []
+        for id in ids:
+            if self.exists(id):
+                yield id
+            else:
+                missing_ids.append(id)
+
+        if len(missing_ids) == 0:
+            return
+
+        with multiprocessing.Pool(processes) as pool:
+            tasks = [(self.path, id, self.nbits, self.backend) for id in missing_ids]
+
+            for id in pool.imap_unordered(_gen_keys, tasks):
+                yield id
+
+    def pub_key(self, id: str):
+        if id not in self.__pub_keys:
+            self.__pub_keys[id] = SIG.load_pub_key(os.path.join(self.path, id), self.backend)
+
+        return self.__pub_keys[id]
+
+    def priv_key(self, id: str):
+        if id not in self.__priv_keys:
+            self.__priv_keys[id] = SIG.load_priv_key(os.path.join(self.path, id), self.backend)
+
+        return self.__priv_keys[id]
+
+
+class AE:
+    """Generates AES keys and nonces, encrypts and decrypts the message.
+
+    AE.encrypt_many and AE.decrypt_many authenticate the messages with AES-GCM, whose nonces are derived from
+    the round and the ids of the two users instead of being sent along.
+    """
+
+    @staticmethod
+    def gen(path: str = None) -> tuple:
+        """Generates the key and nonce using AES algorithm (EAX mode), and saves them.
+
+        Args:
+            path (str): path to store the key and nonce.
+
+        Returns:
+            Tuple[key, nonce]: the key and nonce used to generate the cipher object.
+        """
+
+        key = get_random_bytes(16)
+        nonce = get_random_bytes(16)
+
+        if path is not None:
+            os.makedirs(path)
+
+            # save the key and nonce
+            with open(os.path.join(path, "key"), 'wb') as f:
+                f.write(key)
+            with open(os.path.join(path, "nonce"), 'wb') as f:
+                f.write(nonce)
+
+        return key, nonce
+
+    @staticmethod
+    def encrypt(key: bytes, nonce: bytes, plaintext: bytes) -> bytes:
+        cipher = AES.new(key, AES.MODE_EAX, nonce=nonce)
+        ciphertext = cipher.encrypt(plaintext)
+
+        return ciphertext
+
+    @staticmethod
+    def decrypt(key: bytes, nonce: bytes, ciphertext: bytes) -> bytes:
+        cipher = AES.new(key, AES.MODE_EAX, nonce=nonce)
+        plaintext = cipher.decrypt(ciphertext)
+
+        return plaintext
+
+    tag_size = 16       # the bytes of the GCM tag appended to each record
+
+    @staticmethod
+    def nonce(round: int, sender: str, receiver: str) -> bytes:
+        """Derives the 96-bit GCM nonce of the message sent from sender to receiver in the given round.
+
+        The shared key of two users is used in both directions, so the nonce depends on the direction as well.
+        """
+
+        return struct.pack('>III', round, int(sender), int(receiver))
+
+    @staticmethod
+    def encrypt_many(pairs: list, round: int, ids: list) -> list:
+        """Encrypts and authenticates many messages using AES-GCM.
+
+        Args:
+            pairs (list): the (key, plaintext) pairs.
+            round (int): the current round, which is part of the nonces.
+            ids (list): the (sender, receiver) ids of each message, which are part of the nonces.
+
+        Returns:
+            list: the records of each message, i.e. the ciphertext followed by the 16-byte tag.
+        """
+
+        records = []
+        for (key, plaintext), (sender, receiver) in zip(pairs, ids):
+            cipher = AES.new(key, AES.MODE_GCM, nonce=AE.nonce(round, sender, receiver), mac_len=AE.tag_size)
+            ciphertext, tag = cipher.encrypt_and_digest(plaintext)
+
+            records.append(ciphertext + tag)
+
+        return records
+
+    @staticmethod
+    def decrypt_many(pairs: list, round: int, ids: list) -> list:
+        """Decrypts and verifies many records produced by AE.encrypt_many.
+
+        Args:
+            pairs (list): the (key, record) pairs.
+            round (int): the round in which the records were encrypted.
+            ids (list): the (sender, receiver) ids of each record.
+
+        Returns:
+            list: the plaintext of each record, or None if the record is forged or corrupted.
+        """
+
+        plaintexts = []
+        for (key, record), (sender, receiver) in zip(pairs, ids):
+            cipher = AES.new(key, AES.MODE_GCM, nonce=AE.nonce(round, sender, receiver), mac_len=AE.tag_size)
+
+            try:
+                plaintext = cipher.decrypt_and_verify(record[:-AE.tag_size], record[-AE.tag_size:])
+            except ValueError:
+                plaintext = None
+
+            plaintexts.append(plaintext)
+
+        return plaintexts
+
+
+class PRG:
+    """Expands a 256-bit key into a pseudorandom vector of any length using AES-256 in counter mode.
+
+    Element i of a vector is generated from bytes [i * itemsize, (i + 1) * itemsize) of the key stream, so any
+    slice of a vector can be generated on its own, and independent vectors of one key are selected by the stream.
+    """
+
+    @staticmethod
+    def expand(key: bytes, length: int, stream: int = 0, offset: int = 0, dtype=np.float64) -> np.ndarray:
+        """Generates elements [offset, offset + length) of a pseudorandom vector.
+
+        Args:
+            key (bytes): the 32-byte key, e.g. a shared key of two users or a user's random seed.
+            length (int): the number of elements.
+            stream (int, optional): the index of the vector generated from the key. Defaults to 0.
+            offset (int, optional): the index of the first element. Defaults to 0.
+            dtype (optional): np.float64 for uniform values in [0, 1), or an unsigned integer type for uniform
+                              integers of that width. Defaults to np.float64.
+
+        Returns:
+            np.ndarray: the 1-D pseudorandom vector.
+        """
+
+        dtype = np.dtype(dtype)
+        word_type = np.dtype(np.uint64) if dtype == np.float64 else dtype
+
+        # start from the counter block containing the first element and skip the bytes before it
+        start = offset * word_type.itemsize
+        skip = start % AES.block_size
+
+        buffer = np.zeros(skip + length * word_type.itemsize, dtype=np.uint8)
+        data = memoryview(buffer)
+
+        cipher = AES.new(key, AES.MODE_CTR, nonce=struct.pack('>Q', stream), initial_value=start // AES.block_size)
+        cipher.encrypt(data, output=data)
+
+        words = buffer[skip:].view(word_type)
+
+        if dtype == np.float64:
+            # the top 53 bits of each word are the mantissa of a float in [0, 1)
+            words >>= np.uint64(11)
+
+            return words * 2.0**-53
+
+        return words
+
+    @staticmethod
+    def accumulate(out: np.ndarray, key: bytes, stream: int = 0, offset: int = 0, subtract: bool = False,
+                   block_length: int = 1 << 16):
+        """Adds a pseudorandom vector to out in place, expanding it block by block.
+
+        Args:
+            out (np.ndarray): the C-contiguous accumulator, whose dtype is also the dtype of the vector.
+            key (bytes): the 32-byte key.
+            stream (int, optional): the index of the vector generated from the key. Defaults to 0.
+            offset (int, optional): the index of the element added to out[0]. Defaults to 0.
+            subtract (bool, optional): subtracts the vector instead. Defaults to False.
+            block_length (int, optional): the number of elements expanded at a time. Defaults to 65536.
+        """
+
+        if not out.flags.c_contiguous:
+            raise ValueError("The accumulator must be C-contiguous")
+
+        flat = out.reshape(-1)
+
+        for i in range(0, flat.size, block_length):
+            block = PRG.expand(key, min(block_length, flat.size - i), stream, offset + i, out.dtype)
+
+            if subtract:
+                flat[i:i + block.size] -= block
+            else:
+                flat[i:i + block.size] += block
+
+
+class FixedPoint:
+    """Quantizes real-valued vectors to fixed-point integers in Z_{2^k}, in which masks cancel out exactly.
+
+    A value x is encoded as round(x * 2^frac_bits), clipped to a bits-bit signed integer, mod 2^k, so negative values
+    wrap around like two's complement and a sum of encoded values decodes correctly as long as the real sum lies in
+    [-2^(k - frac_bits - 1), 2^(k - frac_bits - 1)). The vectors are computed in 32-bit words for bits <= 32 and in
+    64-bit words otherwise, and k is the word size unless the ring is narrowed to k = bits + ceil(log2(n)) for n
+    users, which holds any sum of n values (see from_mode). The masked vectors are then sent in k bits per value
+    instead of a word, see BitPacking.
+    """
+
+    modes = {
+        "int8": (8, 5),
+        "int16": (16, 12),
+        "int32": (32, 16),
+        "int64": (64, 32)
+    }
+
+    def __init__(self, bits=32, frac_bits=16, ring_bits: int = None):
+        if not 2 <= bits <= 64:
+            raise ValueError("Only 2-bit to 64-bit values are supported")
+
+        self.bits = bits
+        self.frac_bits = frac_bits
+
+        self.dtype = np.dtype(np.uint32 if bits <= 32 else np.uint64)
+        self.signed_dtype = np.dtype(np.int32 if bits <= 32 else np.int64)
+
+        word_bits = self.dtype.itemsize * 8
+        self.ring_bits = word_bits if ring_bits is None else ring_bits     # k
+        if not bits <= self.ring_bits <= word_bits:
+            raise ValueError("The ring must hold a value and fit in a {}-bit word".format(word_bits))
+
+        # whether the masked vectors are bit-packed, i.e. the ring is narrower than the word
+        self.packed = self.ring_bits < word_bits and BitPacking.min_bits <= self.ring_bits <= BitPacking.max_bits
+
+    @staticmethod
+    def from_mode(mode: str, user_num: int = None):
+        """Returns the FixedPoint of the masking mode, or None for the float mode.
+
+        Args:
+            mode (str): the masking mode, "float" or one of FixedPoint.modes.
+            user_num (int, optional): the number of users, whose sum the ring is narrowed to. Defaults to None for
+                                      the ring of the whole word.
+        """
+
+        if mode == "float":
+            return None
+        if mode not in FixedPoint.modes:
+            raise ValueError("Invalid masking mode: {}".format(mode))
+
+        bits, frac_bits = FixedPoint.modes[mode]
+        if user_num is None:
+            return FixedPoint(bits, frac_bits)
+
+        # ceil(log2(n)) more bits hold the sum of n values
+        ring_bits = min(bits + (user_num - 1).bit_length(), 32 if bits <= 32 else 64)
+
+        return FixedPoint(bits, frac_bits, ring_bits)
+
+    def encode(self, x: np.ndarray) -> np.ndarray:
+        limit = 2.0 ** (self.bits - 1)
+        q = np.clip(np.rint(np.asarray(x, dtype=np.float64) * 2.0 ** self.frac_bits), -limit, np.nextafter(limit, 0))
+
+        return q.astype(self.signed_dtype).view(self.dtype)
+
+    def reduce(self, x: np.ndarray) -> np.ndarray:
+        """Reduces words mod 2^k, e.g. to compare vectors in Z_{2^k}.
+        """
+
+        if self.ring_bits == self.dtype.itemsize * 8:
+            return np.asarray(x, dtype=self.dtype)
+
+        return np.asarray(x, dtype=self.dtype) & self.dtype.type((1 << self.ring_bits) - 1)
+
+    def decode(self, x: np.ndarray) -> np.ndarray:
+        # sign-extend the values of Z_{2^k} to the word
+        shift = self.dtype.itemsize * 8 - self.ring_bits
+
+        return ((np.asarray(x, dtype=self.dtype) << shift).view(self.signed_dtype) >> shift) / 2.0 ** self.frac_bits
+
+
+class BitPacking:
+    """Packs vectors of unsigned integers in exactly bits bits per value, so a masked vector in Z_{2^k} takes k bits
+    per value instead of a 32 or 64-bit word, see FixedPoint.
+
+    Value i occupies bits [i * bits, (i + 1) * bits) of the little-endian packed bytes, so every 8 values take
+    exactly bits bytes, and the j-th value of each group of 8 is read or written as one unaligned 64-bit word at
+    the same offset in all groups. Both directions are then 8 vectorized passes over strided views.
+    """
+
+    min_bits = 8    # a group of 8 values spans at least one 64-bit word, so the words of a pass do not overlap
+    max_bits = 57   # a value shifted by up to 7 bits fits in a 64-bit word
+
+    @staticmethod
+    def size(count: int, bits: int) -> int:
+        """Returns the number of bytes of count packed values.
+        """
+
+        return -(-count * bits // 8)
+
+    @staticmethod
+    def __words(buffer: np.ndarray, count: int, bits: int, j: int) -> np.ndarray:
+        # the unaligned 64-bit words holding the j-th value of each group of 8
+        return np.ndarray((len(range(j, count, 8)),), dtype=np.dtype('<u8'), buffer=buffer, offset=j * bits // 8,
+                          strides=(bits,))
+
+    @staticmethod
+    def pack(x: np.ndarray, bits: int) -> np.ndarray:
+        """Packs the values of x mod 2^bits.
+
+        Args:
+            x (np.ndarray): the unsigned integers, packed in C order.
+            bits (int): the bits per value, from min_bits to max_bits.
+
+        Returns:
+            np.ndarray: the packed bytes, as a uint8 array.
+        """
+
+        if not BitPacking.min_bits <= bits <= BitPacking.max_bits:
+            raise ValueError("Invalid bits per value: {}".format(bits))
+
+        values = np.ravel(x).astype(np.uint64, copy=False) & np.uint64((1 << bits) - 1)
+        count = len(values)
+
+        # 8 more bytes, so the words of the last group stay in the buffer
+        buffer = np.zeros(-(-count // 8) * bits + 8, dtype=np.uint8)
+        for j in range(min(8, count)):
+            words = BitPacking.__words(buffer, count, bits, j)
+            np.bitwise_or(words, values[j::8] << np.uint64(j * bits % 8), out=words)
+
+        return buffer[:BitPacking.size(count, bits)]
+
+    @staticmethod
+    def accumulate(out: np.ndarray, data, bits: int):
+        """Adds the packed values to out in place, so the packed vectors are summed without unpacking them into
+        vectors first.
+
+        Args:
+            out (np.ndarray): the C-contiguous unsigned integers, whose size is the number of packed values.
+            data (bytes-like): the packed bytes.
+            bits (int): the bits per value, from min_bits to max_bits.
+
+        Raises:
+            ValueError: out is not C-contiguous, or the size of the data does not match out.
+        """
+
+        if not BitPacking.min_bits <= bits <= BitPacking.max_bits:
+            raise ValueError("Invalid bits per value: {}".format(bits))
+
+        if not out.flags.c_contiguous:
+            raise ValueError("The accumulator must be C-contiguous")
+
+        flat = out.reshape(-1)
+
+        count = len(flat)
+
+        data = np.frombuffer(data, dtype=np.uint8)
+        if len(data) != BitPacking.size(count, bits):
+            raise ValueError("Expected {} packed bytes, got {}".format(BitPacking.size(count, bits), len(data)))
+
+        buffer = np.zeros(-(-count // 8) * bits + 8, dtype=np.uint8)
+        buffer[:len(data)] = data
+
+        mask = np.uint64((1 << bits) - 1)
+        for j in range(min(8, count)):
+            values = (BitPacking.__words(buffer, count, bits, j) >> np.uint64(j * bits % 8)) & mask
+            flat[j::8] += values.astype(out.dtype, copy=False)
+
+
+class ParamLayout:
+    """Describes how a list of weight arrays, e.g. model.get_weights() of Keras, is laid out in one flat vector.
+
+    Layer i occupies elements [offsets[i], offsets[i] + sizes[i]) of the vector, so the layers can be masked,
+    serialized and summed as one contiguous buffer.
+    """
+
+    def __init__(self, shapes: list, dtypes: list = None):
+        self.shapes = [tuple(shape) for shape in shapes]
+        self.dtypes = [np.dtype(np.float32)] * len(self.shapes) if dtypes is None else [np.dtype(d) for d in dtypes]
+        self.sizes = [int(np.prod(shape)) for shape in self.shapes]
+        self.offsets = [0]
+        for size in self.sizes[:-1]:
+            self.offsets.append(self.offsets[-1] + size)
+        self.size = sum(self.sizes)
+
+    @staticmethod
+    def from_weights(weights: list):
+        return ParamLayout([w.shape for w in weights], [w.dtype for w in weights])
+
+    def flatten(self, weights: list, dtype=np.float64) -> np.ndarray:
+        """Copies the weights into one C-contiguous vector.
+        """
+
+        if [tuple(w.shape) for w in weights] != self.shapes:
+            raise ValueError("The weights do not match the layout")
+
+        vector = np.empty(self.size, dtype=dtype)
+        for w, offset, size in zip(weights, self.offsets, self.sizes):
+            vector[offset:offset + size] = np.ravel(w)
+
+        return vector
+
+    def unflatten(self, vector: np.ndarray) -> list:
+        """Splits a flat vector back into the weights, each of its original shape and dtype.
+        """
+
+        if vector.size != self.size:
+            raise ValueError("The vector does not match the layout")
+
+        return [vector[offset:offset + size].reshape(shape).astype(dtype)
+                for offset, size, shape, dtype in zip(self.offsets, self.sizes, self.shapes, self.dtypes)]
+
+
+class Delta:
+    """Encodes a version of the weights of a model as the bitwise XOR with a base version.
+
+    The XOR is exact for floats, unlike their difference, and its high bytes are zero wherever a weight has kept its
+    sign, exponent and leading mantissa bits, so the deltas shrink as the training converges, see Compression.
+    Version 0 is no weights at all, i.e. a message with base 0 carries the full weights.
+    """
+
+    @staticmethod
+    def __bits(weight: np.ndarray) -> np.ndarray:
+        weight = np.ascontiguousarray(weight)
+
+        return weight.view(np.dtype('<u{}'.format(weight.dtype.itemsize)))
+
+    @staticmethod
+    def encode(weights: list, base: list) -> list:
+        """Returns the deltas of the weights from the base weights, as unsigned integers.
+
+        Raises:
+            ValueError: the weights do not match the base in number, shape or dtype.
+        """
+
+        if len(weights) != len(base) or any(np.shape(w) != np.shape(b) or np.asarray(w).dtype != np.asarray(b).dtype
+                                            for w, b in zip(weights, base)):
+            raise ValueError("The weights do not match the base")
+
+        return [Delta.__bits(w) ^ Delta.__bits(b) for w, b in zip(weights, base)]
+
+    @staticmethod
+    def apply(deltas: list, base: list) -> list:
+        """Returns the weights of the deltas from the base weights, in the dtypes of the base.
+
+        Raises:
+            ValueError: the deltas do not match the base in number, shape or itemsize.
+        """
+
+        if len(deltas) != len(base) or any(d.shape != np.shape(b) or d.dtype.itemsize != np.asarray(b).dtype.itemsize
+                                           for d, b in zip(deltas, base)):
+            raise ValueError("The deltas do not match the base")
+
+        return [(Delta.__bits(d) ^ Delta.__bits(b)).view(np.asarray(b).dtype) for d, b in zip(deltas, base)]
+
+
+class DHAgreement:
+    """Finite field Diffie-Hellman backend over the 2048-bit MODP group 14 of py_diffie_hellman.
+    """
+
+    # the group is fixed, so parse its prime once instead of building a DiffieHellman object per agreement
+    prime = int.from_bytes(PRIMES[14], byteorder="big")
+
+    @staticmethod
+    def gen() -> tuple:
+        dh = DiffieHellman(group=14)
+        pub_key, priv_key = dh.get_public_key(), dh.get_private_key()
+
+        return pub_key, priv_key
+
+    @staticmethod
+    def agree(priv_key: bytes, pub_key: bytes) -> bytes:
+        shared_key = pow(int.from_bytes(pub_key, byteorder="big"),
+                         int.from_bytes(priv_key, byteorder="big"), DHAgreement.prime)
+
+        return shared_key.to_bytes((shared_key.bit_length() + 7) // 8, byteorder="big")
+
+
+@functools.lru_cache(maxsize=4096)
+def _import_x25519_pub_key(pub_key: bytes):
+    from Cryptodome.Protocol.DH import import_x25519_public_key
+
+    return import_x25519_public_key(pub_key)
+
+
+@functools.lru_cache(maxsize=64)
+def _import_x25519_priv_key(priv_key: bytes):
+    from Cryptodome.Protocol.DH import import_x25519_private_key
+
+    return import_x25519_private_key(priv_key)
+
+
+class X25519Agreement:
+    """Elliptic-curve Diffie-Hellman backend over Curve25519 (RFC 7748) using pycryptodomex.
+
+    Both keys are 32-byte strings, and the imported keys are cached so that one user's private key is only
+    decoded once for all its agreements. Curve25519 needs pycryptodomex 3.21.0, which is only imported when this
+    backend is used, so the default DH backend still runs on older images.
+    """
+
+    @staticmethod
+    def gen() -> tuple:
+        key = ECC.generate(curve="Curve25519")
+        pub_key, priv_key = key.public_key().export_key(format="raw"), key.seed
+
+        return pub_key, priv_key
+
+    @staticmethod
+    def agree(priv_key: bytes, pub_key: bytes) -> bytes:
+        from Cryptodome.Protocol.DH import key_agreement
+
+        return key_agreement(static_priv=_import_x25519_priv_key(priv_key),
+                             static_pub=_import_x25519_pub_key(pub_key),
+                             kdf=lambda x: x)
+
+
+class KA:
+    """Generates public and private keys and computes the shared key.
+
+    The key agreement scheme is selected by the backend argument, which is one of the keys of KA.backends.
+    """
+
+    backends = {
+        "dh": DHAgreement,
+        "x25519": X25519Agreement
+    }
+
+    @staticmethod
+    def backend(name: str):
+        if name not in KA.backends:
+            raise ValueError("Invalid key agreement backend: {}".format(name))
+
+        return KA.backends[name]
+
+    @staticmethod
+    def gen(backend="dh") -> tuple:
+        """Generates Diffie-Hellman public and private keys.
+
+        Args:
+            backend (str, optional): the key agreement scheme. Defaults to "dh".
+
+        Returns:
+            Tuple[PublicKey, PrivateKey]: the public and private keys.
+        """
+
+        return KA.backend(backend).gen()
+
+    @staticmethod
+    def agree(priv_key: bytes, pub_key: bytes, backend="dh") -> bytes:
+        """Generates the shared key of two users, and produce 256 bit digest of the shared key.
+
+        Args:
+            priv_key (bytes): the private key of one user.
+            pub_key (bytes): the public key of the other user.
+            backend (str, optional): the key agreement scheme. Defaults to "dh".
+
+        Returns:
+            bytes: the 256 bit shared key of the two users.
+        """
+
+        shared_key = KA.backend(backend).agree(priv_key, pub_key)
+
+        # in order to use AES, produce the 256 bit digest of the shared key using SHA-256
+        h = SHA256.new()
+        h.update(shared_key)
+        key_256 = h.digest()
+
+        return key_256
+
+
+class Wire:
+    """Versioned binary schema of the protocol messages, which replaces pickle on the wire.
+
+    A message starts with the 2-byte magic b"SA", the 1-byte version and the 1-byte type, followed by the fields of
+    its type in the order of Wire.schemas. An id or int is a 4-byte unsigned integer, a phase or byte is 1 byte,
+    bytes are prefixed by their 4-byte length, and lists and maps are prefixed by their 4-byte number of entries. A
+    tensor is its 1-byte dtype code, 1-byte ndim and 8-byte dims, followed by its raw little-endian C-order data
+    aligned to 8 bytes from the start of the message, so decoded tensors are views of the received buffer. All
+    integers are big-endian.
+    """
+
+    magic = b"SA"
+    version = 3
+
+    # message types
+    ADVERTISE_KEYS = 1      # user -> server: c_pk, s_pk and their signature
+    KEY_MAP = 2             # server -> users: all users' c_pk, s_pk and signatures
+    SHARE_KEYS = 3          # user -> server: the encrypted shares for the other users
+    CIPHERTEXTS = 4         # server -> user: the encrypted shares for the user
+    SHARE = 5               # user -> user, encrypted: the shares of s_sk and random seed
+    MASKED_INPUT = 6        # user -> server: the masked vectors
+    ONLINE_USERS = 7        # server -> users: U_3
+    CONSISTENCY_CHECK = 8   # user -> server: the signature of U_3
+    SIGNATURES = 9          # server -> users: all users' signatures of U_3
+    CONSISTENCY_FAILURE = 10    # user -> server: the user failed in consistency check
+    UNMASKING = 11          # user -> server: the shares of dropped users' s_sk and online users' random seeds
+    GLOBAL_WEIGHTS = 12     # server -> users: the weights of the global model, or their delta from a version, see Delta
+    HELLO = 13              # user -> server: the id of the user opening a Connection
+    READY = 14              # user -> server: the user has processed the server's message of a phase
+    STREAM = 15             # server -> users: the number, digests and recipients of the chunks of a disseminated message
+    CHUNK = 16              # server or user -> user: a chunk of a disseminated message, see Dissemination
+    NACK = 17               # user -> server: the missing chunks of a disseminated message
+    COMPRESSED = 18         # server -> user: a compressed message, see Compression
+    MASKED_PACKED = 19      # user -> server: the masked vectors in Z_{2^k} packed in k bits per value, see BitPacking
+    WEIGHTS_ACK = 20        # user -> server: the version of the global weights the user has
+    WELCOME = 21            # server -> user: the round of the next global weights, which a connecting user joins
+
+    schemas = {
+        ADVERTISE_KEYS: [("id", "id"), ("c_pk", "bytes"), ("s_pk", "bytes"), ("signature", "bytes")],
+        KEY_MAP: [("keys", "key_map")],
+        SHARE_KEYS: [("id", "id"), ("ciphertexts", "bytes_map")],
+        CIPHERTEXTS: [("ciphertexts", "bytes_map")],
+        SHARE: [("u", "id"), ("v", "id"), ("s_sk_share", "bytes"), ("random_seed_share", "bytes")],
+        MASKED_INPUT: [("id", "id"), ("tensors", "tensors")],
+        ONLINE_USERS: [("ids", "ids")],
+        CONSISTENCY_CHECK: [("id", "id"), ("signature", "bytes")],
+        SIGNATURES: [("signatures", "bytes_map")],
+        CONSISTENCY_FAILURE: [("id", "id")],
+        UNMASKING: [("id", "id"), ("priv_key_shares", "bytes_map"), ("random_seed_shares", "bytes_map")],
+        GLOBAL_WEIGHTS: [("version", "int"), ("base", "int"), ("tensors", "tensors")],
+        HELLO: [("id", "id"), ("codecs", "ints")],
+        READY: [("id", "id"), ("phase", "phase")],
+        STREAM: [("count", "int"), ("fanout", "int"), ("ids", "ids"), ("digests", "bytes")],
+        CHUNK: [("seq", "int"), ("data", "bytes")],
+        NACK: [("id", "id"), ("phase", "phase"), ("seqs", "ints")],
+        COMPRESSED: [("codec", "byte"), ("shuffle", "byte"), ("size", "int"), ("data", "bytes")],
+        MASKED_PACKED: [("id", "id"), ("bits", "byte"), ("shape", "ints"), ("tensors", "tensors")],
+        WEIGHTS_ACK: [("id", "id"), ("version", "int")],
+        WELCOME: [("round", "int")]
+    }
+
+    # the phase of each message type, which tags it on a Connection, i.e. 0 for the session and the global weights,
+    # then 1 to 5 for the rounds of advertising keys, sharing keys, masked input collection, consistency check and
+    # unmasking. STREAM and CHUNK are tagged by the phase of the disseminated message, and COMPRESSED by the phase of
+    # the compressed one.
+    phases = {
+        HELLO: 0,
+        READY: 0,
+        NACK: 0,
+        GLOBAL_WEIGHTS: 0,
+        WEIGHTS_ACK: 0,
+        WELCOME: 0,
+        ADVERTISE_KEYS: 1,
+        KEY_MAP: 1,
+        SHARE_KEYS: 2,
+        CIPHERTEXTS: 2,
+        SHARE: 2,
+        MASKED_INPUT: 3,
+        MASKED_PACKED: 3,
+        ONLINE_USERS: 4,
+        CONSISTENCY_CHECK: 4,
+        SIGNATURES: 4,
+        CONSISTENCY_FAILURE: 4,
+        UNMASKING: 5
+    }
+
+    dtypes = {
+        1: np.dtype('<f8'),
+        2: np.dtype('<f4'),
+        3: np.dtype('<u4'),
+        4: np.dtype('<u8'),
+        5: np.dtype('<i4'),
+        6: np.dtype('<i8'),
+        7: np.dtype('u1')
+    }
+    dtype_codes = {dtype: code for code, dtype in dtypes.items()}
+
+    @staticmethod
+    def encode(msg_type: int, **fields) -> list:
+        """Encodes a message without copying its tensors.
+
+        Args:
+            msg_type (int): the message type, e.g. Wire.MASKED_INPUT.
+            **fields: the fields of the message type, see Wire.schemas.
+
+        Returns:
+            list: the bytes-like parts of the message, to be sent in order, see SocketUtil.send_msg.
+        """
+
+        if msg_type not in Wire.schemas:
+            raise ValueError("Invalid message type: {}".format(msg_type))
+
+        # the small fields are packed into one buffer, and each tensor is a part on its own
+        parts = []
+        buffer = bytearray(Wire.magic + struct.pack('>BB', Wire.version, msg_type))
+        size = 0
+
+        def pack_bytes(data):
+            return struct.pack('>I', len(data)) + data
+
+        for name, kind in Wire.schemas[msg_type]:
+            value = fields[name]
+
+            if kind == "id":
+                buffer += struct.pack('>I', int(value))
+            elif kind == "bytes":
+                buffer += pack_bytes(value)
+            elif kind in ("phase", "byte"):
+                buffer += struct.pack('>B', value)
+            elif kind == "int":
+                buffer += struct.pack('>I', value)
+            elif kind == "ints":
+                buffer += struct.pack('>I{}I'.format(len(value)), len(value), *value)
+            elif kind == "ids":
+                buffer += struct.pack('>I{}I'.format(len(value)), len(value), *[int(id) for id in value])
+            elif kind == "bytes_map":
+                buffer += struct.pack('>I', len(value))
+                buffer += b"".join(struct.pack('>II', int(id), len(data)) + data for id, data in value.items())
+            elif kind == "key_map":
+                buffer += struct.pack('>I', len(value))
+                buffer += b"".join(struct.pack('>I', int(id)) + pack_bytes(keys["c_pk"]) + pack_bytes(keys["s_pk"]) +
+                                   pack_bytes(keys["signature"]) for id, keys in value.items())
+            elif kind == "tensors":
+                buffer += struct.pack('>I', len(value))
+                for tensor in value:
+                    tensor = np.asarray(tensor)
+                    dtype = tensor.dtype.newbyteorder('<')
+                    if dtype not in Wire.dtype_codes:
+                        raise ValueError("Unsupported dtype: {}".format(tensor.dtype))
+                    tensor = np.ascontiguousarray(tensor, dtype=dtype)
+
+                    buffer += struct.pack('>BB{}Q'.format(tensor.ndim), Wire.dtype_codes[dtype], tensor.ndim,
+                                          *tensor.shape)
+                    buffer += bytes(-(size + len(buffer)) % 8)
+
+                    parts.append(buffer)
+                    parts.append(memoryview(tensor).cast('B'))
+                    size += len(buffer) + tensor.nbytes
+                    buffer = bytearray()
+
+        if len(buffer) > 0:
+            parts.append(buffer)
+
+        return parts
+
+    @staticmethod
+    def dumps(msg_type: int, **fields) -> bytes:
+        return b"".join(Wire.encode(msg_type, **fields))
+
+    @staticmethod
+    def message_type(data) -> int:
+        """Returns the type of a message, or raises ValueError if it is not a message of this version.
+        """
+
+        if len(data) < 4 or bytes(data[:2]) != Wire.magic:
+            raise ValueError("Not a protocol message")
+
+        version, msg_type = struct.unpack_from('>BB', data, 2)
+        if version != Wire.version:
+            raise ValueError("Unsupported message version: {}".format(version))
+        if msg_type not in Wire.schemas:
+            raise ValueError("Invalid message type: {}".format(msg_type))
+
+        return msg_type
+
+    @staticmethod
+    def decode(data, msg_type: int) -> dict:
+        """Decodes a message of the expected type.
+
+        Args:
+            data (bytes-like): the received message. Tensors are views of it, which are writable for a bytearray.
+            msg_type (int): the expected message type.
+
+        Returns:
+            dict: the fields of the message, with ids as str.
+
+        Raises:
+            ValueError: the message is malformed or of another type.
+        """
+
+        received_type = Wire.message_type(data)
+        if received_type != msg_type:
+            raise ValueError("Unexpected message type: {}".format(received_type))
+
+        view = memoryview(data).cast('B')
+        pos = 4
+
+        def unpack(fmt):
+            nonlocal pos
+            try:
+                values = struct.unpack_from(fmt, view, pos)
+            except struct.error:
+                raise ValueError("Truncated message")
+            pos += struct.calcsize(fmt)
+            return values
+
+        def take(n):
+            nonlocal pos
+            if pos + n > len(view):
+                raise ValueError("Truncated message")
+            pos += n
+            return view[pos - n:pos]
+
+        def get_bytes():
+            return bytes(take(unpack('>I')[0]))
+
+        fields = {}
+        for name, kind in Wire.schemas[msg_type]:
+            if kind == "id":
+                value = str(unpack('>I')[0])
+            elif kind == "bytes":
+                value = get_bytes()
+            elif kind in ("phase", "byte"):
+                value = unpack('>B')[0]
+            elif kind == "int":
+                value = unpack('>I')[0]
+            elif kind == "ints":
+                n = unpack('>I')[0]
+                value = list(unpack('>{}I'.format(n)))
+            elif kind == "ids":
+                n = unpack('>I')[0]
+                value = [str(id) for id in unpack('>{}I'.format(n))]
+            elif kind == "bytes_map":
+                value = {}
+                for _ in range(unpack('>I')[0]):
+                    id, n = unpack('>II')
+                    value[str(id)] = bytes(take(n))
+            elif kind == "key_map":
+                value = {}
+                for _ in range(unpack('>I')[0]):
+                    id = str(unpack('>I')[0])
+                    value[id] = {"c_pk": get_bytes(), "s_pk": get_bytes(), "signature": get_bytes()}
+            elif kind == "tensors":
+                value = []
+                for _ in range(unpack('>I')[0]):
+                    code, ndim = unpack('>BB')
+                    if code not in Wire.dtypes:
+                        raise ValueError("Unsupported dtype code: {}".format(code))
+                    shape = unpack('>{}Q'.format(ndim))
+                    take(-pos % 8)
+
+                    dtype = Wire.dtypes[code]
+                    count = int(np.prod(shape))
+                    tensor = np.frombuffer(take(count * dtype.itemsize), dtype=dtype)
+                    value.append(tensor.reshape(shape))
+
+            fields[name] = value
+
+        if pos != len(view):
+            raise ValueError("Trailing bytes in message")
+
+        return fields
+
+
+class Compression:
+    """Compresses the large messages sent by the server with a codec negotiated per Connection.
+
+    A user advertises the codecs it can decompress in its HELLO message, and the server compresses a message of a
+    type in Compression.policies with the first of the type's codecs the recipient supports, if the message has at
+    least threshold bytes and gets smaller. The message is byte-shuffled first, i.e. the k-th bytes of all w-byte
+    words are grouped, so the mostly equal high bytes of ids and the exponents of floats compress well. Keys,
+    signatures, ciphertexts, shares and masked vectors are random bytes, so they are never compressed, see
+    benchmark.py.
+    """
+
+    # codecs
+    ZLIB = 1
+    LZMA = 2
+    LZ4 = 3
+
+    # {codec: (compress, decompressor)}, where decompressor().decompress(data, max_length) is bounded by the size
+    backends = {
+        ZLIB: (functools.partial(zlib.compress, level=1), zlib.decompressobj),
+        LZMA: (functools.partial(lzma.compress, preset=0), lzma.LZMADecompressor)
+    }
+    if lz4 is not None:
+        backends[LZ4] = (lz4.frame.compress, lz4.frame.LZ4FrameDecompressor)
+
+    # {message type: (codecs in order of preference, shuffle width)}. The shuffled ids of 1000 users shrink to 9% with
+    # lz4 or zlib, and shuffled float32 weights to 85% with zlib at 25 ms/MB, which is paid once per dissemination
+    # and saves 15% of every recipient's download, see benchmark.py -c.
+    policies = {
+        Wire.ONLINE_USERS: ([LZ4, ZLIB], 4),
+        Wire.GLOBAL_WEIGHTS: ([ZLIB, LZ4], 4)
+    }
+
+    threshold = 1024    # the minimum size of a compressed message
+
+    @staticmethod
+    def available() -> list:
+        """Returns the codecs this process can decompress, which are advertised in HELLO.
+        """
+
+        return list(Compression.backends)
+
+    @staticmethod
+    def shuffle(data, width: int, inverse: bool = False) -> bytearray:
+        """Groups the k-th bytes of the width-byte words of the data, or ungroups them if inverse. The trailing bytes
+        are kept as they are.
+        """
+
+        view = memoryview(data).cast('B')
+        n = len(view) - len(view) % width
+
+        words = np.frombuffer(view[:n], dtype=np.uint8)
+        words = words.reshape(width, -1) if inverse else words.reshape(-1, width)
+
+        shuffled = bytearray(len(view))
+        np.frombuffer(shuffled, dtype=np.uint8)[:n] = words.T.ravel()
+        shuffled[n:] = view[n:]
+
+        return shuffled
+
+    @staticmethod
+    def encode(msg, codec: int, shuffle: int = 1) -> bytes:
+        """Compresses a message into a COMPRESSED message.
+
+        Args:
+            msg (bytes or list): the message, or its parts, see Wire.encode.
+            codec (int): the codec, one of Compression.backends.
+            shuffle (int, optional): the width of the byte shuffle, 1 for none. Defaults to 1.
+
+        Returns:
+            bytes: the COMPRESSED message.
+        """
+
+        data = b"".join(msg) if isinstance(msg, list) else msg
+        if shuffle > 1:
+            data = Compression.shuffle(data, shuffle)
+
+        compress = Compression.backends[codec][0]
+
+        return Wire.dumps(Wire.COMPRESSED, codec=codec, shuffle=shuffle, size=len(data), data=compress(data))
+
+    @staticmethod
+    def compress(msg, codecs: list):
+        """Compresses a message according to Compression.policies.
+
+        Args:
+            msg (bytes or list): the message, or its parts, see Wire.encode.
+            codecs (list): the codecs the recipient can decompress.
+
+        Returns:
+            bytes or list: the COMPRESSED message, or the message itself if it is not worth compressing.
+        """
+
+        parts = msg if isinstance(msg, list) else [msg]
+        policy = Compression.policies.get(Wire.message_type(parts[0]))
+        if policy is None:
+            return msg
+
+        size = sum(memoryview(part).nbytes for part in parts)
+        codec = next((codec for codec in policy[0] if codec in codecs and codec in Compression.backends), None)
+        if codec is None or size < Compression.threshold:
+            return msg
+
+        compressed = Compression.encode(parts, codec, policy[1])
+
+        return compressed if len(compressed) < size else msg
+
+    @staticmethod
+    def decompress(data):
+        """Decompresses a COMPRESSED message, and returns any other message as it is.
+
+        Returns:
+            bytearray: the message, whose tensors are writable views of it, see Wire.decode.
+
+        Raises:
+            ValueError: the message is malformed or compressed by an unknown codec.
+        """
+
+        if len(data) < 4 or data[3] != Wire.COMPRESSED or bytes(data[:2]) != Wire.magic:
+            return data
+
+        fields = Wire.decode(data, Wire.COMPRESSED)
+        if fields["codec"] not in Compression.backends:
+            raise ValueError("Unsupported codec: {}".format(fields["codec"]))
+        if fields["shuffle"] == 0 or fields["size"] == 0:
+            raise ValueError("Invalid compressed message")
+
+        decompressor = Compression.backends[fields["codec"]][1]()
+        try:
+            # bounded by the size, so a malicious message cannot exhaust the memory
+            msg = decompressor.decompress(fields["data"], fields["size"])
+        except Exception as e:
+            raise ValueError("Corrupted compressed message: {}".format(e))
+
+        if len(msg) != fields["size"] or not decompressor.eof or decompressor.unused_data:
+            raise ValueError("Corrupted compressed message of {} bytes".format(fields["size"]))
+
+        if fields["shuffle"] > 1:
+            return Compression.shuffle(msg, fields["shuffle"], inverse=True)
+
+        return bytearray(msg)
+
+
+class SocketUtil:
+    """Sends and receives messages using socket.
+
+    A message is framed by its 4-byte length. It may be sent as a list of bytes-like parts, e.g. from Wire.encode,
+    so large tensors are sent straight from their memory, and it is received into one preallocated bytearray.
+    """
+
+    max_size = 256 * 1024 * 1024    # the maximum size of a received message, which bounds the allocated bytearray
+
+    @staticmethod
+    def send_msg(sock, msg):
+        parts = msg if isinstance(msg, list) else [msg]
+
+        # add packet size
+        sock.sendall(struct.pack('>I', sum(memoryview(part).nbytes for part in parts)))
+        for part in parts:
+            sock.sendall(part)
+
+    @staticmethod
+    def recv_msg(sock):
+        raw_msg_len = SocketUtil.recvall(sock, 4)
+
+        if not raw_msg_len:
+            return None
+
+        msg_len = struct.unpack('>I', raw_msg_len)[0]
+
+        return SocketUtil.recvall(sock, msg_len)
+
+    @staticmethod
+    def recvall(sock, n):
+        """Receives exactly n bytes into a preallocated bytearray, or returns None if the connection is closed.
+
+        Raises:
+            ValueError: n exceeds max_size, e.g. a corrupt or forged message length.
+        """
+
+        if n > SocketUtil.max_size:
+            raise ValueError("Message size {} exceeds the maximum {}".format(n, SocketUtil.max_size))
+
+        data = bytearray(n)
+        view = memoryview(data)
+
+        received = 0
+        while received < n:
+            size = sock.recv_into(view[received:], n - received)
+
+            if size == 0:
+                return None
+
+            received += size
+
+        return data
+
+
+class Connection:
+    """A long-lived duplex connection between a user and the server, which carries the messages of all rounds.
+
+    Each message is framed by its 4-byte length, 4-byte round and 1-byte phase (see Wire.phases), so the messages
+    of different rounds and phases are multiplexed over one socket. A listening connection reads the messages in a
+    background thread and queues them by (round, phase), so they can be received in any order.
+    """
+
+    header = struct.Struct('>IIB')
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.send_lock = threading.Lock()
+
+        self.queues = {}        # {(round, phase): queue.Queue}
+        self.queues_lock = threading.Lock()
+        self.closed = False
+
+    @staticmethod
+    def connect(host: str, port: int, timeout: float = 60):
+        """Connects to host:port, retrying until the server is up or the timeout expires.
+        """
+
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                sock = socket.create_connection((host, port))
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.5)
+
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        return Connection(sock)
+
+    def send(self, round: int, phase: int, msg):
+        """Sends a message, or its parts from Wire.encode, tagged by the round and phase.
+        """
+
+        parts = msg if isinstance(msg, list) else [msg]
+        size = sum(memoryview(part).nbytes for part in parts)
+
+        with self.send_lock:
+            self.sock.sendall(Connection.header.pack(size, round, phase))
+            for part in parts:
+                self.sock.sendall(part)
+
+    def recv_frame(self) -> tuple:
+        """Receives the next message.
+
+        Returns:
+            Tuple[int, int, bytearray]: the round, phase and message, or None if the connection is closed. A frame
+                                        larger than SocketUtil.max_size closes the connection.
+        """
+
+        try:
+            header = SocketUtil.recvall(self.sock, Connection.header.size)
+            if header is None:
+                return None
+
+            size, round, phase = Connection.header.unpack(header)
+            data = SocketUtil.recvall(self.sock, size)
+        except OSError:
+            return None
+        except ValueError as e:
+            logging.error("received an invalid frame: %s", e)
+            self.close()
+            return None
+
+        if data is None:
+            return None
+
+        return round, phase, data
+
+    def listen(self):
+        """Starts reading the messages into the queues in a background thread.
+        """
+
+        thread = threading.Thread(target=self.__read)
+        thread.daemon = True
+        thread.start()
+
+    def put(self, round: int, phase: int, data):
+        """Queues a message of the round and phase as if it was received, e.g. a chunk relayed by another user.
+        """
+
+        with self.queues_lock:
+            self.queues.setdefault((round, phase), queue.Queue()).put(data)
+
+    def __read(self):
+        while True:
+            frame = self.recv_frame()
+            if frame is None:
+                break
+
+            round, phase, data = frame
+            try:
+                data = Compression.decompress(data)
+            except ValueError as e:
+                logging.error("received a malformed compressed message: %s", e)
+                continue
+
+            self.put(round, phase, data)
+
+        # wake up the waiting receivers
+        with self.queues_lock:
+            self.closed = True
+            for q in self.queues.values():
+                q.put(None)
+
+    def recv(self, round: int, phase: int, timeout: float = None):
+        """Receives the next message of the round and phase, see listen.
+
+        Returns:
+            bytearray: the message, or None if the connection is closed or the timeout expires.
+        """
+
+        key = (round, phase)
+        with self.queues_lock:
+            q = self.queues.setdefault(key, queue.Queue())
+            if self.closed and q.empty():
+                return None
+
+        try:
+            data = q.get(timeout=timeout)
+        except queue.Empty:
+            data = None
+
+        # drop the drained queue, a message arriving later creates a new one
+        with self.queues_lock:
+            if q.empty() and self.queues.get(key) is q and not self.closed:
+                del self.queues[key]
+
+        return data
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+        self.sock.close()
+
+
+class Dissemination:
+    """Reliable dissemination of a message from the server to many users over their Connections, which replaces the
+    UDP broadcast.
+
+    The message is split into sequence-numbered CHUNKs, and the server sends every recipient a STREAM header with the
+    number of chunks, their SHA-256 digests and the recipients, all tagged by the round and phase of the message. A
+    chunk is only accepted, and relayed, if it matches its digest in the header, so a relaying user cannot corrupt
+    the message of its subtree. The server sends the chunks
+    to the first fanout recipients only, and every recipient relays each new chunk to its next fanout recipients in
+    the order of the ids, so the chunks travel O(log n) hops instead of n sends from the server. With a fanout of 0,
+    the server sends the chunks to every recipient itself. A recipient that has received no chunk for repair_timeout
+    seconds requests the missing ones from the server with a NACK, so a failed relay only delays its subtree.
+    """
+
+    chunk_size = 64 * 1024
+    repair_timeout = 1.0
+
+    @staticmethod
+    def split(msg, ids: list, fanout: int) -> tuple:
+        """Splits a message into chunks.
+
+        Args:
+            msg (bytes or list): the message, or its parts, see Wire.encode.
+            ids (list): the ids of the recipients.
+            fanout (int): the number of recipients every node sends the chunks to, 0 for the server sending to all.
+
+        Returns:
+            Tuple[bytes, list]: the STREAM header and the CHUNK messages.
+        """
+
+        data = memoryview(b"".join(msg) if isinstance(msg, list) else msg)
+
+        chunks = [Wire.dumps(Wire.CHUNK, seq=seq, data=data[i:i + Dissemination.chunk_size])
+                  for seq, i in enumerate(range(0, len(data), Dissemination.chunk_size))]
+        digests = b"".join(SHA256.new(chunk).digest() for chunk in chunks)
+        header = Wire.dumps(Wire.STREAM, count=len(chunks), fanout=fanout, ids=ids, digests=digests)
+
+        return header, chunks
+
+    @staticmethod
+    def children(ids: list, id: str, fanout: int) -> list:
+        """Returns the recipients a node sends the chunks to, where the k-th recipient receives them from the
+        (k // fanout)-th one, the server being the 0-th.
+
+        Args:
+            ids (list): the ids of the recipients.
+            id (str): the id of the node, None for the server.
+            fanout (int): the fanout of the dissemination.
+
+        Returns:
+            list: the ids of the children.
+        """
+
+        if fanout == 0:
+            return list(ids) if id is None else []
+
+        i = 0 if id is None else ids.index(id) + 1
+
+        return ids[i * fanout:(i + 1) * fanout]
+
+    @staticmethod
+    def recv(connection, round: int, phase: int, id: str, relay=None) -> bytearray:
+        """Receives a disseminated message, relaying the new chunks and requesting the missing ones.
+
+        Args:
+            connection (Connection): the user's listening Connection to the server, which also receives the relayed
+                                     chunks, see Connection.listen.
+            round (int): the round of the message.
+            phase (int): the phase of the message.
+            id (str): the id of the user.
+            relay (callable, optional): relay(children, round, phase, data) relays a chunk to the children, and
+                                        returns the unreachable ones, which are skipped for the rest of the message.
+
+        Returns:
+            bytearray: the message, decompressed if it was compressed, or None if the connection is closed.
+
+        Raises:
+            ValueError: the message cannot be decompressed, see Compression.decompress.
+        """
+
+        header = None
+        children = []
+        chunks = {}     # {seq: CHUNK message}
+        pending = []    # the CHUNK messages received before the header, which are checked against its digests
+
+        def valid(seq, chunk) -> bool:
+            digest = header["digests"][seq * SHA256.digest_size:(seq + 1) * SHA256.digest_size]
+            if seq >= header["count"] or SHA256.new(chunk).digest() != digest:
+                logging.warning("dropped chunk %d of a message of phase %d which does not match its digest", seq, phase)
+                return False
+
+            return True
+
+        while header is None or len(chunks) < header["count"]:
+            # the header is sent by the server itself, so only the chunks are repaired
+            data = connection.recv(round, phase, None if header is None else Dissemination.repair_timeout)
+            if data is None:
+                if connection.closed:
+                    return None
+
+                missing = [seq for seq in range(header["count"]) if seq not in chunks]
+                connection.send(round, Wire.phases[Wire.NACK], Wire.dumps(Wire.NACK, id=id, phase=phase, seqs=missing))
+                continue
+
+            try:
+                msg_type = Wire.message_type(data)
+                if msg_type == Wire.STREAM:
+                    if header is not None:
+                        continue
+
+                    header = Wire.decode(data, Wire.STREAM)
+                    if len(header["digests"]) != header["count"] * SHA256.digest_size:
+                        raise ValueError("Invalid number of digests: {}".format(len(header["digests"])))
+
+                    children = Dissemination.children(header["ids"], id, header["fanout"])
+                    new_chunks = []
+                    for seq, chunk in pending:
+                        if seq not in chunks and valid(seq, chunk):
+                            chunks[seq] = chunk
+                            new_chunks.append(chunk)
+                elif msg_type == Wire.CHUNK:
+                    seq = Wire.decode(data, Wire.CHUNK)["seq"]
+                    if seq in chunks:
+                        continue
+
+                    if header is None:
+                        pending.append((seq, data))
+                        continue
+
+                    if not valid(seq, data):
+                        continue
+
+                    chunks[seq] = data
+                    new_chunks = [data]
+                else:
+                    raise ValueError("Unexpected message type: {}".format(msg_type))
+            except ValueError as e:
+                logging.error("received a malformed chunk: %s", e)
+                continue
+
+            if relay is not None:
+                for chunk in new_chunks:
+                    if len(children) == 0:
+                        break
+
+                    failed = relay(children, round, phase, chunk)
+                    children = [v for v in children if v not in failed]
+
+        msg = bytearray()
+        for seq in range(header["count"]):
+            msg += Wire.decode(chunks[seq], Wire.CHUNK)["data"]
+
+        return Compression.decompress(msg)
+
+
+class PhaseBarrier:
+    """Counts the messages of a phase as they arrive, so the coordinator proceeds as soon as the expected number
+    has arrived or the deadline has passed, instead of polling.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.count = 0
+
+    def arrive(self):
+        with self.condition:
+            self.count += 1
+            self.condition.notify_all()
+
+    def wait(self, target: int, timeout: float = None) -> int:
+        """Waits until at least target messages have arrived or the timeout expires.
+
+        Returns:
+            int: the number of the arrived messages.
+        """
+
+        with self.condition:
+            self.condition.wait_for(lambda: self.count >= target, timeout)
+
+            return self.count
+
+    def reset(self):
+        with self.condition:
+            self.count = 0
+
+
+class SS:
+    """Shamir's t-out-of-n Secret Sharing over the prime field GF(2^521 - 1).
+
+    A secret is split into 64-byte blocks, each block being the constant term of its own sharing polynomial, and
+    the polynomials of all blocks are evaluated at all n holders at once. A share is the 4-byte x coordinate of
+    its holder followed by one 66-byte y coordinate per block.
+    """
+
+    prime = 2**521 - 1
+    block_size = 64         # the bytes of the secret stored in one field element
+    element_size = 66       # the bytes of one serialized field element
+
+    @staticmethod
+    def encode(secret: object) -> list:
+        """Encodes a bytes or int secret into field elements.
+        """
+
+        if isinstance(secret, bytes):
+            data = b"b" + secret
+        elif isinstance(secret, int):
+            data = b"i" + secret.to_bytes(secret.bit_length() // 8 + 1, byteorder="big", signed=True)
+        else:
+            raise TypeError("Secret must be bytes or int, not {}".format(type(secret).__name__))
+
+        data = struct.pack('>I', len(data)) + data
+        data += bytes(-len(data) % SS.block_size)
+
+        return [int.from_bytes(data[i:i + SS.block_size], byteorder="big")
+                for i in range(0, len(data), SS.block_size)]
+
+    @staticmethod
+    def decode(blocks: list) -> object:
+        """Decodes the field elements produced by SS.encode into the secret.
+        """
+
+        if any(block >> (8 * SS.block_size) for block in blocks):
+            raise ValueError("Invalid shares")
+
+        data = b"".join(int(block).to_bytes(SS.block_size, byteorder="big") for block in blocks)
+
+        data_len = struct.unpack_from('>I', data)[0]
+        if data_len < 1 or data_len > len(data) - 4:
+            raise ValueError("Invalid shares")
+
+        data = data[4:4 + data_len]
+        if data[:1] == b"b":
+            return data[1:]
+        elif data[:1] == b"i":
+            return int.from_bytes(data[1:], byteorder="big", signed=True)
+        else:
+            raise ValueError("Invalid shares")
+
+    @staticmethod
+    def share(secret: object, t: int, n: int) -> list:
+        """Generates a set of shares.
+
+        Args:
+            secret (object): the secret to be split, bytes or int.
+            t (int): the threshold of being able to reconstruct the secret.
+            n (int): the number of the shares.
+
+        Returns:
+            list: a set of shares, the i-th share (bytes) belongs to the holder whose x coordinate is i + 1.
+        """
+
+        if t < 1 or t > n:
+            raise ValueError("Threshold must be between 1 and the number of the shares")
+
+        blocks = SS.encode(secret)
+
+        # coeffs[j][b] is the coefficient of x^j in the sharing polynomial of block b
+        coeffs = np.empty((t, len(blocks)), dtype=object)
+        coeffs[0] = blocks
+        for j in range(1, t):
+            coeffs[j] = [secrets.randbelow(SS.prime) for _ in blocks]
+
+        # evaluate all polynomials at x = 1, ..., n with Horner's method
+        xs = np.arange(1, n + 1, dtype=object).reshape((n, 1))
+        ys = np.tile(coeffs[t - 1], (n, 1))
+        for j in range(t - 2, -1, -1):
+            ys = (ys * xs + coeffs[j]) % SS.prime
+
+        shares = []
+        for i in range(n):
+            share = struct.pack('>I', i + 1) + b"".join(int(y).to_bytes(SS.element_size, byteorder="big")
+                                                          for y in ys[i])
+            shares.append(share)
+
+        return shares
+
+    @staticmethod
+    def parse(share: bytes) -> tuple:
+        """Parses a share into its x coordinate and the y coordinates of all blocks.
+        """
+
+        if len(share) < 4 or (len(share) - 4) % SS.element_size != 0:
+            raise ValueError("Invalid share")
+
+        x = struct.unpack_from('>I', share)[0]
+        ys = [int.from_bytes(share[i:i + SS.element_size], byteorder="big")
+              for i in range(4, len(share), SS.element_size)]
+
+        return x, ys
+
+    @staticmethod
+    @functools.lru_cache(maxsize=16)
+    def lagrange(xs: tuple) -> np.ndarray:
+        """Computes the Lagrange coefficients which interpolate the polynomial at 0 from the given x coordinates.
+
+        The holder set is usually the same for all secrets of a round, so the coefficients are cached.
+        """
+
+        m = len(xs)
+        xs = np.array(xs, dtype=object)
+
+        # nums[i] = prod(x_j), dens[i] = prod(x_j - x_i) for all j != i
+        nums = np.ones(m, dtype=object)
+        dens = np.ones(m, dtype=object)
+        for j in range(m):
+            x_j = np.full(m, xs[j], dtype=object)
+            diff = x_j - xs
+            x_j[j] = 1
+            diff[j] = 1
+
+            nums = nums * x_j % SS.prime
+            dens = dens * diff % SS.prime
+
+        return np.array([num * pow(int(den), -1, SS.prime) % SS.prime for num, den in zip(nums, dens)], dtype=object)
+
+    @staticmethod
+    def recon(shares: list):
+        """Reconstructs the secret from at least t shares.
+
+        Args:
+            shares (list): the shares generated by SS.share.
+
+        Returns:
+            object: the secret.
+        """
+
+        return SS.recon_many([shares])[0]
+
+    @staticmethod
+    def recon_many(shares_list: list) -> list:
+        """Reconstructs many secrets at once. The secrets whose shares come from the same holders are
+        reconstructed by one product of the cached Lagrange coefficients and the matrix of all their blocks.
+
+        Args:
+            shares_list (list): the shares of each secret.
+
+        Returns:
+            list: the secrets.
+        """
+
+        groups = {}     # {xs: [(index, ys)]}, the secrets shared by the same holders
+        for index, shares in enumerate(shares_list):
+            points = sorted(SS.parse(share) for share in shares)
+            xs = tuple(x for x, _ in points)
+
+            if len(set(xs)) != len(xs) or len(set(len(ys) for _, ys in points)) != 1:
+                raise ValueError("Invalid shares")
+
+            groups.setdefault(xs, []).append((index, [ys for _, ys in points]))
+
+        secrets_list = [None] * len(shares_list)
+        for xs, items in groups.items():
+            # stack the blocks of all secrets column by column, i.e. ys[i] holds all blocks of holder i
+            ys = np.concatenate([np.array(item_ys, dtype=object) for _, item_ys in items], axis=1)
+
+            blocks = SS.lagrange(xs).dot(ys) % SS.prime
+
+            start = 0
+            for index, item_ys in items:
+                end = start + len(item_ys[0])
+                secrets_list[index] = SS.decode(blocks[start:end])
+                start = end
+
+        return secrets_list
@@ -7,6 +7,7 @@ import numpy as np
 import tensorflow as tf
 
 from user import User
+from utils import FixedPoint, ParamLayout, Wire
 from tensorflow.keras.initializers import RandomNormal
 
 os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
@@ -42,25 +43,20 @@ def advertise_keys(user):
 
     signature = user.gen_signature()
 
-    msg = pickle.dumps({
-        "id": user.id,
-        "c_pk": user.c_pk,
-        "s_pk": user.s_pk,
-        "signature": signature
-    })
+    msg = Wire.encode(Wire.ADVERTISE_KEYS, id=user.id, c_pk=user.c_pk, s_pk=user.s_pk, signature=signature)
 
     # send c_pk, s_pk and the corresponding signature
-    user.send(msg, "server", 20000)
+    user.send(msg)
 
     # listen the broadcast from the server
-    user.listen_broadcast(10000)
+    user.listen_broadcast()
 
 
 def share_keys(user, t):
     if not user.ver_signature():
         sys.exit(1)
 
-    user.gen_shares(user.U_1, t, "server", 20001)
+    user.gen_shares(user.U_1, t)
 
     user.listen_ciphertexts()
 
@@ -76,6 +72,8 @@ if __name__ == "__main__":
     iteration = int(sys.argv[3])
     model_name = sys.argv[4]
     batch_size = int(sys.argv[5])
+    ka_backend = sys.argv[6] if len(sys.argv) > 6 else "dh"
+    mode = sys.argv[7] if len(sys.argv) > 7 else "float"
 
     # get training dataset
     dataset_url = "http://ta:5000/getDataset"
@@ -87,9 +85,19 @@ if __name__ == "__main__":
     req = requests.get(key_url)
     data = pickle.loads(req.content)
 
-    user = User(id, data["pubKeyMap"][id], data["privKey"])
+    # the ring holds the sum of all users' gradients, as on the server
+    fixed_point = FixedPoint.from_mode(mode, len(data["pubKeyMap"]))
+
+    user = User(id, data["pubKeyMap"][id], data["privKey"], data["sigBackend"], ka_backend, fixed_point)
     user.pub_key_map = data["pubKeyMap"]
 
+    # open the only connection to the server used by all rounds
+    user.connect("server", 20000)
+
+    # relay the disseminated messages to the other users
+    user.peer_address = lambda v: ("user" + v, 10001)
+    user.serve_peers(10001)
+
     user_ids = user.pub_key_map.keys()
 
     model = create_model(model_name)
@@ -104,14 +112,15 @@ if __name__ == "__main__":
 
         model.fit(dataset['x'], dataset['y'], batch_size=batch_size, epochs=20)
 
-        gradients = model.get_weights()
+        weights = model.get_weights()
+        gradients = ParamLayout.from_weights(weights).flatten(weights)
 
         advertise_keys(user)
 
         share_keys(user, t)
 
-        user.mask_gradients(gradients, "server", 20002)
+        user.mask_gradients(gradients)
 
-        user.consistency_check("server", 20003)
+        user.consistency_check()
 
-        user.unmask_gradients("server", 20004)
+        user.unmask_gradients()
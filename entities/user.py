@@ -1,8 +1,8 @@
 import sys
 import pickle
-import random
 import socket
 import logging
+import threading
 import numpy as np
 
 from utils import *
@@ -12,14 +12,20 @@ socket.SO_REUSEPORT = socket.SO_REUSEADDR
 
 
 class User:
-    def __init__(self, id: str, pub_key: bytes, priv_key: bytes):
+    def __init__(self, id: str, pub_key: bytes, priv_key: bytes, sig_backend="rsa", ka_backend="dh",
+                 fixed_point: FixedPoint = None):
         self.id = id
-        self.host = socket.gethostname()
-        self.port = int("1" + id.zfill(4))
+        self.connection = None      # the Connection to the server, see connect
+        self.peer_address = None    # maps a user's id to the (host, port) of its serve_peers, None for no relaying
+        self.peers = {}             # {id: Connection}, the users this user relays disseminated messages to
+        self.streams = set()        # the (round, phase) of the disseminated messages being received
 
         self.pub_key = pub_key
         self.__priv_key = priv_key
         self.pub_key_map = []
+        self.sig_backend = sig_backend      # the signature scheme of all users' keys, see SIG.backends
+        self.ka_backend = ka_backend        # the key agreement scheme of the c and s key pairs, see KA.backends
+        self.fixed_point = fixed_point      # the fixed-point masking mode, None for masking floats
 
         self.c_pk = None
         self.__c_sk = None
@@ -28,6 +34,15 @@ class User:
 
         self.ka_pub_keys_map = None
 
+        self.round = 0      # the number of key pairs generated so far, which is part of the nonces of AE
+
+        # per-round pairwise key tables {id: shared key}, filled on first use and reset with the key pairs
+        self.__c_shared_keys = {}
+        self.__s_shared_keys = {}
+
+        # the digests of the ka_pub_keys_map entries whose signatures have been verified
+        self.__verified_digests = set()
+
         self.__random_seed = None
 
         self.ciphertexts = None
@@ -35,229 +50,395 @@ class User:
         self.U_3 = None
 
     def gen_DH_pairs(self):
-        self.c_pk, self.__c_sk = KA.gen()
-        self.s_pk, self.__s_sk = KA.gen()
+        self.round += 1
+
+        self.c_pk, self.__c_sk = KA.gen(self.ka_backend)
+        self.s_pk, self.__s_sk = KA.gen(self.ka_backend)
+
+        self.__c_shared_keys = {}
+        self.__s_shared_keys = {}
+
+    def __c_shared_key(self, v: str) -> bytes:
+        """Returns the shared key of c_sk and user v's c_pk, which is only agreed once per round.
+        """
+
+        if v not in self.__c_shared_keys:
+            v_c_pk = self.ka_pub_keys_map[v]["c_pk"]
+            self.__c_shared_keys[v] = KA.agree(self.__c_sk, v_c_pk, self.ka_backend)
+
+        return self.__c_shared_keys[v]
+
+    def __s_shared_key(self, v: str) -> bytes:
+        """Returns the shared key of s_sk and user v's s_pk, which is only agreed once per round.
+        """
+
+        if v not in self.__s_shared_keys:
+            v_s_pk = self.ka_pub_keys_map[v]["s_pk"]
+            self.__s_shared_keys[v] = KA.agree(self.__s_sk, v_s_pk, self.ka_backend)
+
+        return self.__s_shared_keys[v]
 
     def gen_signature(self):
         msg = pickle.dumps([self.c_pk, self.s_pk])
-        signature = SIG.sign(msg, self.__priv_key)
+        signature = SIG.sign(msg, self.__priv_key, self.sig_backend)
 
         return signature
 
     def ver_signature(self) -> bool:
         status = True
+
+        ids = []
+        digests = []
+        entries = []                # [(msg, signature, pub_key)] to be verified
+        verified_digests = set()    # only keep the digests of the current entries
         for key, value in self.ka_pub_keys_map.items():
             msg = pickle.dumps([value["c_pk"], value["s_pk"]])
 
-            res = SIG.verify(msg, value["signature"], self.pub_key_map[key])
+            # skip the entries which have been verified and are unchanged since then
+            digest = SHA256.new(pickle.dumps([value["c_pk"], value["s_pk"], value["signature"],
+                                              self.pub_key_map[key]])).digest()
+            if digest in self.__verified_digests:
+                verified_digests.add(digest)
+                continue
+
+            ids.append(key)
+            digests.append(digest)
+            entries.append((msg, value["signature"], self.pub_key_map[key]))
 
+        for key, digest, res in zip(ids, digests, SIG.verify_many(entries, self.sig_backend)):
             if res is False:
                 status = False
                 logging.error("user {}'s signature is wrong!".format(key))
+            else:
+                verified_digests.add(digest)
+
+        self.__verified_digests = verified_digests
 
         return status
 
-    def send(self, msg: bytes, host: str, port: int):
-        """Sends message to host:port.
+    def connect(self, host: str, port: int):
+        """Opens the Connection to the server used by all later rounds.
 
         Args:
-            msg (bytes): the message to be sent.
-            host (str): the target host.
-            port (int): the target port.
+            host (str): the server's host.
+            port (int): the server's port of the Connections.
         """
 
-        sock = socket.socket()
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
-        sock.connect((host, port))
+        self.connection = Connection.connect(host, port)
+        # advertise the codecs of the messages compressed by the server
+        hello = Wire.dumps(Wire.HELLO, id=self.id, codecs=Compression.available())
+        self.connection.send(0, Wire.phases[Wire.HELLO], hello)
+        self.connection.listen()
+
+    def send(self, msg):
+        """Sends message to the server, tagged by the current round and the phase of the message.
+
+        Args:
+            msg (bytes or list): the message to be sent, or its parts, see Wire.encode.
+        """
 
-        SocketUtil.send_msg(sock, msg)
+        msg_type = Wire.message_type(msg[0] if isinstance(msg, list) else msg)
 
-        sock.close()
+        self.connection.send(self.round, Wire.phases[msg_type], msg)
 
-    def listen_broadcast(self, port: int):
-        """Listens to the server's broadcast, and saves all users' key pairs and corresponding signatures.
+    def recv(self, msg_type: int, round: int = None):
+        """Receives the next message of the type from the server.
 
         Args:
-            port (int): the port used to broadcast the message.
+            msg_type (int): the expected message type, see Wire.
+            round (int, optional): the round of the message. Defaults to the current round.
+
+        Returns:
+            Tuple[bytearray, dict]: the message and its fields, or None if the connection is closed or the message
+                                    is malformed.
         """
 
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        data = self.connection.recv(self.round if round is None else round, Wire.phases[msg_type])
+        if data is None:
+            logging.error("the connection to the server is closed")
+            return None
 
-        # reuse port so we will be able to run multiple clients on single (host, port).
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        try:
+            return data, Wire.decode(data, msg_type)
+        except ValueError as e:
+            logging.error("received a malformed message from the server: %s", e)
+            return None
 
-        # enable broadcasting mode
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    def ready(self, phase: int):
+        """Acknowledges that the server's message of the phase has been processed, so the server can move on.
+
+        Args:
+            phase (int): the phase of the message, see Wire.phases.
+        """
+
+        self.send(Wire.dumps(Wire.READY, id=self.id, phase=phase))
+
+    def serve_peers(self, port: int):
+        """Accepts the users relaying disseminated messages to this user, see Dissemination.
+
+        Only the CHUNKs of the messages being received are queued on the Connection to the server, where they are
+        checked against the digests of the server's STREAM header. A peer sending any other message is disconnected.
+
+        Args:
+            port (int): the port of the relayed messages.
+        """
+
+        sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 
         sock.bind(("", port))
+        sock.listen()
+
+        def serve(peer):
+            while True:
+                frame = peer.recv_frame()
+                if frame is None:
+                    break
+
+                round, phase, data = frame
+                try:
+                    msg_type = Wire.message_type(data)
+                except ValueError:
+                    msg_type = None
 
-        data = SocketUtil.recv_broadcast(sock)
+                if msg_type != Wire.CHUNK:
+                    logging.warning("rejected a message of type %s relayed by another user", msg_type)
+                    break
 
-        self.ka_pub_keys_map = pickle.loads(data)
+                # the chunks of a message which is not being received are late duplicates
+                if (round, phase) in self.streams:
+                    self.connection.put(round, phase, data)
+
+            peer.close()
+
+        def accept():
+            while True:
+                conn, _ = sock.accept()
+
+                thread = threading.Thread(target=serve, args=[Connection(conn)])
+                thread.daemon = True
+                thread.start()
+
+        thread = threading.Thread(target=accept)
+        thread.daemon = True
+        thread.start()
+
+    def relay(self, children: list, round: int, phase: int, data) -> list:
+        """Relays a chunk of a disseminated message to the children, whose missing chunks are repaired by the server.
+
+        Returns:
+            list: the children which cannot be reached.
+        """
+
+        failed = []
+        for v in children:
+            try:
+                if v not in self.peers:
+                    host, port = self.peer_address(v)
+                    self.peers[v] = Connection.connect(host, port, Dissemination.repair_timeout)
+
+                self.peers[v].send(round, phase, data)
+            except OSError as e:
+                logging.warning("failed to relay a chunk to user %s: %s", v, e)
+
+                failed.append(v)
+                if v in self.peers:
+                    self.peers.pop(v).close()
+
+        return failed
+
+    def recv_disseminated(self, msg_type: int, round: int = None):
+        """Receives the next disseminated message of the type from the server, see Dissemination.
+
+        Args:
+            msg_type (int): the expected message type, see Wire.
+            round (int, optional): the round of the message. Defaults to the current round.
+
+        Returns:
+            Tuple[bytearray, dict]: the message and its fields, or None if the connection is closed or the message
+                                    is malformed.
+        """
+
+        relay = self.relay if self.peer_address is not None else None
+        stream = (self.round if round is None else round, Wire.phases[msg_type])
+
+        self.streams.add(stream)
+        try:
+            data = Dissemination.recv(self.connection, *stream, self.id, relay)
+            if data is None:
+                logging.error("the connection to the server is closed")
+                return None
+
+            return data, Wire.decode(data, msg_type)
+        except ValueError as e:
+            logging.error("received a malformed message from the server: %s", e)
+            return None
+        finally:
+            self.streams.discard(stream)
+
+    def listen_broadcast(self):
+        """Receives all users' key pairs and corresponding signatures disseminated by the server.
+        """
+
+        res = self.recv_disseminated(Wire.KEY_MAP)
+        if res is None:
+            return
+
+        self.ka_pub_keys_map = res[1]["keys"]
 
         logging.info("received all signatures from the server")
 
-        sock.close()
+        self.ready(Wire.phases[Wire.KEY_MAP])
 
-    def gen_shares(self, U_1: list, t: int, host: str, port: int):
+    def gen_shares(self, U_1: list, t: int):
         """Generates random seed for a PRG, generates t-out-of-U1 shares of the s_sk and random seed,
            and encrypts these shares using the shared key of the two users.
 
         Args:
             U_1 (list): all users who have sent DH key pairs.
             t (int): the threshold value of secret sharing scheme.
-            host (str): the server's host.
-            port (int): the server's port used to receive these shares.
         """
 
-        # generates a random integer from 0 to 2**32 - 1 (to be used as a seed for PRG)
-        self.__random_seed = random.randint(0, 2**32 - 1)
+        # generates a random 256-bit key (to be used as a seed for PRG)
+        self.__random_seed = get_random_bytes(32)
 
         n = len(U_1)
 
         s_sk_shares = SS.share(self.__s_sk, t, n)
         random_seed_shares = SS.share(self.__random_seed, t, n)
 
-        all_ciphertexts = {}       # {id: ciphertext}
-
+        receivers = []
+        pairs = []      # [(shared key, plaintext)]
         for i, v in enumerate(U_1):
             if v == self.id:
                 continue
 
-            info = pickle.dumps([self.id, v, s_sk_shares[i], random_seed_shares[i]])
+            info = Wire.dumps(Wire.SHARE, u=self.id, v=v, s_sk_share=s_sk_shares[i],
+                              random_seed_share=random_seed_shares[i])
 
-            v_c_pk = self.ka_pub_keys_map[v]["c_pk"]
-            shared_key = KA.agree(self.__c_sk, v_c_pk)
+            receivers.append(v)
+            pairs.append((self.__c_shared_key(v), info))
 
-            ciphertext = AE.encrypt(shared_key, shared_key, info)
+        ciphertexts = AE.encrypt_many(pairs, self.round, [(self.id, v) for v in receivers])
 
-            all_ciphertexts[v] = ciphertext
+        all_ciphertexts = dict(zip(receivers, ciphertexts))      # {id: ciphertext}
 
-        msg = pickle.dumps([self.id, all_ciphertexts])
+        msg = Wire.encode(Wire.SHARE_KEYS, id=self.id, ciphertexts=all_ciphertexts)
 
         # send all shares of the s_sk and random seed to the server
-        self.send(msg, host, port)
+        self.send(msg)
 
     def listen_ciphertexts(self):
         """Listens to the server for the ciphertexts.
         """
 
-        sock = socket.socket()
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
-
-        sock.bind(("", self.port))
-        sock.listen()
-
-        conn, _ = sock.accept()
+        res = self.recv(Wire.CIPHERTEXTS)
+        if res is None:
+            return
 
-        data = SocketUtil.recv_msg(conn)
-        self.ciphertexts = pickle.loads(data)
+        self.ciphertexts = res[1]["ciphertexts"]
 
         logging.info("received ciphertext from the server")
 
-        sock.close()
+        self.ready(Wire.phases[Wire.CIPHERTEXTS])
 
-    def mask_gradients(self, gradients: np.ndarray, host: str, port: int):
+    def mask_gradients(self, gradients: np.ndarray):
         """Masks user's own gradients and generates corresponding verification gradients. Then, sends them to the server.
 
+        With a fixed-point masking mode, the gradients are quantized first and all vectors are masked in Z_{2^k}.
+
         Args:
             gradients (np.ndarray): user's raw gradients.
-            host (str): the server's host.
-            port (int): the server's port used to receive the masked gradients.
         """
 
         U_2 = list(self.ciphertexts.keys())
 
-        # generate user's own private mask vector p_u_0 and p_u_1
-        rs = np.random.RandomState(self.__random_seed | 0)
-        priv_mask_vec_0 = rs.random(gradients.shape)
-        rs = np.random.RandomState(self.__random_seed | 1)
-        priv_mask_vec_1 = rs.random(gradients.shape)
+        dtype = np.float64 if self.fixed_point is None else self.fixed_point.dtype
 
-        # generate random vectors p_u_v_0 and p_u_v_1 for each user
-        random_vec_0_list = []
-        random_vec_1_list = []
-        alpha = 0
+        # expand α into two random vectors
+        alpha = 10000
+        if self.fixed_point is None:
+            rs = np.random.RandomState(alpha | 0)
+            self.__a = rs.random(gradients.shape)
+            rs = np.random.RandomState(alpha | 1)
+            self.__b = rs.random(gradients.shape)
+        else:
+            rs = np.random.RandomState(alpha | 0)
+            self.__a = rs.randint(0, 2**self.fixed_point.ring_bits, gradients.shape, dtype=dtype)
+            rs = np.random.RandomState(alpha | 1)
+            self.__b = rs.randint(0, 2**self.fixed_point.ring_bits, gradients.shape, dtype=dtype)
+
+            gradients = self.fixed_point.encode(gradients)
+
+        # the two output buffers, into which every mask is accumulated in place as soon as it is generated,
+        # so the peak memory is O(d) rather than O(n * d)
+        masked_gradients = np.array(gradients, dtype=dtype, order="C")
+        verification_gradients = self.__a * masked_gradients + self.__b
+
+        # add user's own private mask vector p_u_0 and p_u_1
+        PRG.accumulate(masked_gradients, self.__random_seed, stream=0)
+        PRG.accumulate(verification_gradients, self.__random_seed, stream=1)
+
+        # add random vectors p_u_v_0 and p_u_v_1 for each user,
+        # where unsigned subtraction wraps around, i.e. -p = 2^k - p in the fixed-point modes
         for v in U_2:
             if v == self.id:
                 continue
 
-            v_s_pk = self.ka_pub_keys_map[v]["s_pk"]
-            shared_key = KA.agree(self.__s_sk, v_s_pk)
-
-            random.seed(shared_key)
-            s_u_v = random.randint(0, 2**32 - 1)
-            alpha = (alpha + s_u_v) % (2 ** 32)
-
-            # expand s_u_v into two random vectors
-            rs = np.random.RandomState(s_u_v | 0)
-            p_u_v_0 = rs.random(gradients.shape)
-            rs = np.random.RandomState(s_u_v | 1)
-            p_u_v_1 = rs.random(gradients.shape)
-            if int(self.id) > int(v):
-                random_vec_0_list.append(p_u_v_0)
-                random_vec_1_list.append(p_u_v_1)
-            else:
-                random_vec_0_list.append(-p_u_v_0)
-                random_vec_1_list.append(-p_u_v_1)
-
-        # expand α into two random vectors
-        alpha = 10000
-        rs = np.random.RandomState(alpha | 0)
-        self.__a = rs.random(gradients.shape)
-        rs = np.random.RandomState(alpha | 1)
-        self.__b = rs.random(gradients.shape)
-
-        verification_code = self.__a * gradients + self.__b
-
-        masked_gradients = gradients + priv_mask_vec_0 + np.sum(np.array(random_vec_0_list), axis=0)
-        verification_gradients = verification_code + priv_mask_vec_1 + np.sum(np.array(random_vec_1_list), axis=0)
-
-        msg = pickle.dumps([self.id, masked_gradients, verification_gradients])
+            shared_key = self.__s_shared_key(v)
+            subtract = int(self.id) < int(v)
 
-        # send the masked gradients to the server
-        self.send(msg, host, port)
-
-    def consistency_check(self, host: str, port: int, status_list: list):
-        sock = socket.socket()
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            PRG.accumulate(masked_gradients, shared_key, stream=0, subtract=subtract)
+            PRG.accumulate(verification_gradients, shared_key, stream=1, subtract=subtract)
 
-        sock.bind(("", self.port))
-        sock.listen()
+        # send the masked gradients to the server, in k bits per value if the ring is narrower than the words
+        if self.fixed_point is not None and self.fixed_point.packed:
+            bits = self.fixed_point.ring_bits
+            msg = Wire.encode(Wire.MASKED_PACKED, id=self.id, bits=bits, shape=list(masked_gradients.shape),
+                              tensors=[BitPacking.pack(masked_gradients, bits),
+                                       BitPacking.pack(verification_gradients, bits)])
+        else:
+            msg = Wire.encode(Wire.MASKED_INPUT, id=self.id, tensors=[masked_gradients, verification_gradients])
+        self.send(msg)
 
-        conn, _ = sock.accept()
+    def consistency_check(self):
+        res = self.recv(Wire.ONLINE_USERS)
+        if res is None:
+            return
 
-        data = SocketUtil.recv_msg(conn)
-        self.U_3 = pickle.loads(data)
+        data, msg = res
+        self.U_3 = msg["ids"]
 
         logging.info("received U_3 from the server")
 
-        signature = SIG.sign(data, self.__priv_key)
-        msg = pickle.dumps([self.id, signature])
+        signature = SIG.sign(data, self.__priv_key, self.sig_backend)
+        msg = Wire.encode(Wire.CONSISTENCY_CHECK, id=self.id, signature=signature)
+
+        self.send(msg)
 
-        self.send(msg, host, port)
+        res = self.recv(Wire.SIGNATURES)
+        if res is None:
+            return
 
-        conn, _ = sock.accept()
-        data = SocketUtil.recv_msg(conn)
-        signature_map = pickle.loads(data)
+        signature_map = res[1]["signatures"]
 
+        # the encoding is canonical, so it is the message signed by every user
+        msg = Wire.dumps(Wire.ONLINE_USERS, ids=self.U_3)
         for key, value in signature_map.items():
-            res = SIG.verify(pickle.dumps(self.U_3), value, self.pub_key_map[key])
+            res = SIG.verify(msg, value, self.pub_key_map[key], self.sig_backend)
 
             if res is False:
                 logging.error("user {}'s signature is wrong!".format(key))
-                status_list.append(False)
+
+                msg = Wire.encode(Wire.CONSISTENCY_FAILURE, id=self.id)
+                self.send(msg)
 
                 sys.exit(1)
 
-        sock.close()
+        self.ready(Wire.phases[Wire.SIGNATURES])
 
-    def unmask_gradients(self, host: str, port: str):
+    def unmask_gradients(self):
         """Sends the shares of offline users' private key and online users' random seed to the server.
-
-        Args:
-            host (str): the server's host.
-            port (str): the server's port used to receive the shares.
         """
 
         U_2 = list(self.ciphertexts.keys())
@@ -265,27 +446,42 @@ class User:
         priv_key_shares_map = {}
         random_seed_shares_map = {}
 
-        for v in U_2:
-            if self.id == v:
+        senders = [v for v in U_2 if v != self.id]
+        pairs = [(self.__c_shared_key(v), self.ciphertexts[v]) for v in senders]
+        plaintexts = AE.decrypt_many(pairs, self.round, [(v, self.id) for v in senders])
+
+        for v, plaintext in zip(senders, plaintexts):
+            if plaintext is None:
+                logging.error("user {}'s ciphertext is wrong!".format(v))
                 continue
 
-            v_c_pk = self.ka_pub_keys_map[v]["c_pk"]
-            shared_key = KA.agree(self.__c_sk, v_c_pk)
+            try:
+                info = Wire.decode(plaintext, Wire.SHARE)
+            except ValueError as e:
+                logging.error("user {}'s shares are malformed: {}".format(v, e))
+                continue
 
-            info = pickle.loads(AE.decrypt(shared_key, shared_key, self.ciphertexts[v]))
+            if info["u"] != v or info["v"] != self.id:
+                logging.error("user {}'s shares are not for user {}!".format(v, self.id))
+                continue
 
             if v not in self.U_3:
                 # send the shares of s_sk to the server
-                priv_key_shares_map[v] = info[2]
+                priv_key_shares_map[v] = info["s_sk_share"]
             else:
                 # send the shares of random seed to the server
-                random_seed_shares_map[v] = info[3]
+                random_seed_shares_map[v] = info["random_seed_share"]
 
-        msg = pickle.dumps([self.id, priv_key_shares_map, random_seed_shares_map])
+        msg = Wire.encode(Wire.UNMASKING, id=self.id, priv_key_shares=priv_key_shares_map,
+                          random_seed_shares=random_seed_shares_map)
 
-        self.send(msg, host, port)
+        self.send(msg)
 
     def verify(self, output_gradients, verification_gradients, num_U_3):
         gradients_prime = self.__a * output_gradients + num_U_3 * self.__b
 
+        if self.fixed_point is not None:
+            # the sums are exact in Z_{2^k}
+            return (self.fixed_point.reduce(gradients_prime) == self.fixed_point.reduce(verification_gradients)).all()
+
         return ((gradients_prime - verification_gradients) < np.full(output_gradients.shape, 1e-6)).all()
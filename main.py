@@ -1,6 +1,4 @@
 import sys
-import time
-import pickle
 import logging
 import argparse
 
@@ -21,33 +19,54 @@ U_3 = []            # ids of all users sending the masked gradients
 U_4 = []            # ids of all users sending the consistency check
 
 
-def init(user_ids: list) -> dict:
-    """Generate all users and the server, and generates RSA keys for signature.
+def init(user_ids: list, key_path: str, sig_backend: str, ka_backend: str, fixed_point: FixedPoint = None,
+         fanout: int = 0) -> dict:
+    """Generate all users and the server, and generates keys for signature.
 
     Args:
         user_ids (list): the ids of all users.
+        key_path (str): the directory of the keystore storing all users' keys.
+        sig_backend (str): the signature scheme, see SIG.backends.
+        ka_backend (str): the key agreement scheme, see KA.backends.
+        fixed_point (FixedPoint, optional): the fixed-point masking mode. Defaults to masking floats.
+        fanout (int, optional): the fanout of the dissemination, see Dissemination. Defaults to 0, i.e. the server
+                                sends to all users.
     """
 
-    entities["server"] = Server()
+    keystore = KeyStore(key_path, nbits=1024, backend=sig_backend)
+
+    # generate the missing keys in parallel before starting any server thread
+    with tqdm(total=len(user_ids), desc='Generating keys', unit_scale=True, unit='') as bar:
+        for _ in keystore.generate(user_ids):
+            bar.update(1)
+
+    entities["server"] = Server(ka_backend, fixed_point, fanout)
     SignatureRequestHandler.user_num = len(user_ids)
+    MaskingRequestHandler.dtype = np.float64 if fixed_point is None else fixed_point.dtype
+    MaskingRequestHandler.ring_bits = fixed_point.ring_bits if fixed_point is not None and fixed_point.packed else None
 
-    # start the signature socket server
-    server_thread = Thread(target=entities["server"].signature_server.serve_forever)
+    # start the session socket server, every user then keeps one connection to it for the whole session
+    server_thread = Thread(target=entities["server"].session_server.serve_forever)
     server_thread.daemon = True
     server_thread.start()
 
     pub_key_map = {}    # the dict storing all users' public keys
 
-    with tqdm(total=len(user_ids), desc='Generating keys', unit_scale=True, unit='') as bar:
-        for id in user_ids:
-            pub_key, priv_key = SIG.gen(nbits=1024)
-            pub_key_map[id] = pub_key
-            entities[id] = User(id, pub_key, priv_key)
+    for id in user_ids:
+        pub_key_map[id] = keystore.pub_key(id)
+        entities[id] = User(id, pub_key_map[id], keystore.priv_key(id), sig_backend, ka_backend, fixed_point)
 
-            bar.update(1)
+    def peer_address(id):
+        return entities["server"].host, int("1" + id.zfill(4))
 
     for id in user_ids:
         entities[id].pub_key_map = pub_key_map
+        entities[id].connect(entities["server"].host, entities["server"].port)
+
+        # the users relay the disseminated messages to each other
+        if fanout > 0:
+            entities[id].peer_address = peer_address
+            entities[id].serve_peers(peer_address(id)[1])
 
     global t
     t = int(0.8 * len(user_ids))
@@ -72,20 +91,13 @@ def advertise_keys(user_ids: list) -> bool:
 
         signature = user.gen_signature()
 
-        msg = pickle.dumps({
-            "id": user.id,
-            "c_pk": user.c_pk,
-            "s_pk": user.s_pk,
-            "signature": signature
-        })
+        msg = Wire.encode(Wire.ADVERTISE_KEYS, id=user.id, c_pk=user.c_pk, s_pk=user.s_pk, signature=signature)
 
         # send c_pk, s_pk and the corresponding signature
-        user.send(msg, server.host, server.signature_port)
+        user.send(msg)
 
         # listen the broadcast from the server
-        thread = Thread(target=user.listen_broadcast, args=[server.broadcast_port])
-        thread.daemon = True
-        thread.start()
+        user.listen_broadcast()
 
     for id in user_ids:
         user = entities[id]
@@ -94,20 +106,18 @@ def advertise_keys(user_ids: list) -> bool:
         thread.daemon = True
         thread.start()
 
-    time.sleep(0.2)
-
-    cnt = 0
-    while len(SignatureRequestHandler.U_1) != user_num and cnt < wait_time:
-        time.sleep(1)
-        cnt += 1
+    SignatureRequestHandler.barrier.wait(user_num, wait_time)
 
     if len(SignatureRequestHandler.U_1) >= t:
         global U_1
-        U_1 = SignatureRequestHandler.U_1
+        U_1 = list(SignatureRequestHandler.U_1)
 
         logging.info("{} users have sent signatures".format(len(U_1)))
 
-        server.broadcast_signatures(server.broadcast_port)
+        failed = server.broadcast_signatures()
+
+        # wait for the users to receive the keys
+        ReadyRequestHandler.barriers[Wire.phases[Wire.KEY_MAP]].wait(len(U_1) - len(failed), wait_time)
 
         return True
     else:
@@ -127,21 +137,14 @@ def share_keys() -> bool:
     server = entities["server"]
     SecretShareRequestHandler.U_1_num = len(U_1)
 
-    # start the secret sharing socket server
-    server_thread = Thread(target=server.ss_server.serve_forever)
-    server_thread.daemon = True
-    server_thread.start()
-
     def fun(user):
         if not user.ver_signature():
             sys.exit(1)
 
-        user.gen_shares(U_1, t, server.host, server.ss_port)
+        user.gen_shares(U_1, t)
 
         # listen shares from the server
-        thread = Thread(target=user.listen_ciphertexts)
-        thread.daemon = True
-        thread.start()
+        user.listen_ciphertexts()
 
     for u in U_1:
         user = entities[u]
@@ -150,22 +153,19 @@ def share_keys() -> bool:
         thread.daemon = True
         thread.start()
 
-    time.sleep(0.2)
-
-    cnt = 0
-    while len(SecretShareRequestHandler.U_2) != len(U_1) and cnt < wait_time:
-        time.sleep(1)
-        cnt += 1
+    SecretShareRequestHandler.barrier.wait(len(U_1), wait_time)
 
     if len(SecretShareRequestHandler.U_2) >= t:
         global U_2
-        U_2 = SecretShareRequestHandler.U_2
+        U_2 = list(SecretShareRequestHandler.U_2)
 
         logging.info("{} users have sent ciphertexts".format(len(U_2)))
 
-        for u in U_2:
-            msg = pickle.dumps(SecretShareRequestHandler.ciphertexts_map[u])
-            server.send(msg, entities[u].host, entities[u].port)
+        failed = server.send_many({u: Wire.encode(Wire.CIPHERTEXTS, ciphertexts=SecretShareRequestHandler.ciphertexts_map[u])
+                                   for u in U_2})
+
+        # wait for the users to receive the ciphertexts
+        ReadyRequestHandler.barriers[Wire.phases[Wire.CIPHERTEXTS]].wait(len(U_2) - len(failed), wait_time)
 
         return True
     else:
@@ -187,13 +187,8 @@ def masked_input_collection(user_gradients: dict) -> bool:
     server = entities["server"]
     MaskingRequestHandler.U_2_num = len(U_2)
 
-    # start the masked gradients collection socket server
-    server_thread = Thread(target=server.masking_server.serve_forever)
-    server_thread.daemon = True
-    server_thread.start()
-
     def fun(user):
-        user.mask_gradients(user_gradients[user.id], server.host, server.masking_port)
+        user.mask_gradients(user_gradients[user.id])
 
     for u in U_2:
         user = entities[u]
@@ -202,16 +197,11 @@ def masked_input_collection(user_gradients: dict) -> bool:
         thread.daemon = True
         thread.start()
 
-    time.sleep(0.2)
-
-    cnt = 0
-    while len(MaskingRequestHandler.U_3) != len(U_2) and cnt < wait_time:
-        time.sleep(1)
-        cnt += 1
+    MaskingRequestHandler.barrier.wait(len(U_2), wait_time)
 
     if len(MaskingRequestHandler.U_3) >= t:
         global U_3
-        U_3 = MaskingRequestHandler.U_3
+        U_3 = list(MaskingRequestHandler.U_3)
 
         logging.info("{} users have sent masked gradients".format(len(U_3)))
 
@@ -225,41 +215,29 @@ def consistency_check() -> int:
     server = entities["server"]
     ConsistencyRequestHandler.U_3_num = len(U_3)
 
-    # start the consistency check socket server
-    server_thread = Thread(target=server.consistency_server.serve_forever)
-    server_thread.daemon = True
-    server_thread.start()
-
-    status_list = []
-
     for u in U_3:
-        thread = Thread(target=entities[u].consistency_check, args=[
-                        server.host, server.consistency_port, status_list])
+        thread = Thread(target=entities[u].consistency_check)
         thread.daemon = True
         thread.start()
 
-    msg = pickle.dumps(U_3)
-    for u in U_3:
-        server.send(msg, entities[u].host, entities[u].port)
+    msg = Wire.encode(Wire.ONLINE_USERS, ids=U_3)
+    failed = server.send_many({u: msg for u in U_3})
 
-    time.sleep(0.2)
-
-    cnt = 0
-    while len(ConsistencyRequestHandler.U_4) != len(U_3) and cnt < wait_time:
-        time.sleep(1)
-        cnt += 1
+    ConsistencyRequestHandler.barrier.wait(len(U_3) - len(failed), wait_time)
 
     if len(ConsistencyRequestHandler.U_4) >= t:
         global U_4
-        U_4 = ConsistencyRequestHandler.U_4
+        U_4 = list(ConsistencyRequestHandler.U_4)
 
         logging.info("{} users have sent consistency checks".format(len(U_4)))
 
-        for u in U_4:
-            msg = pickle.dumps(ConsistencyRequestHandler.consistency_check_map)
-            server.send(msg, entities[u].host, entities[u].port)
+        msg = Wire.encode(Wire.SIGNATURES, signatures=ConsistencyRequestHandler.consistency_check_map)
+        failed = server.send_many({u: msg for u in U_4})
+
+        # wait for the users to verify the signatures, a failed user reports it at once
+        ReadyRequestHandler.barriers[Wire.phases[Wire.SIGNATURES]].wait(len(U_4) - len(failed), wait_time)
 
-        if False in status_list:
+        if len(ConsistencyRequestHandler.status_list) != 0:
             # at least one user failed in consistency check
             return 2
         else:
@@ -283,22 +261,12 @@ def unmasking(shape: tuple) -> np.ndarray:
     server = entities["server"]
     UnmaskingRequestHandler.U_4_num = len(U_4)
 
-    # start the unmasking socket server
-    server_thread = Thread(target=server.unmasking_server.serve_forever)
-    server_thread.daemon = True
-    server_thread.start()
-
     for u in U_4:
-        thread = Thread(target=entities[u].unmask_gradients, args=[server.host, server.unmasking_port])
+        thread = Thread(target=entities[u].unmask_gradients)
         thread.daemon = True
         thread.start()
 
-    time.sleep(0.2)
-
-    cnt = 0
-    while len(UnmaskingRequestHandler.U_5) != len(U_4) and cnt < wait_time:
-        time.sleep(1)
-        cnt += 1
+    UnmaskingRequestHandler.barrier.wait(len(U_4), wait_time)
 
     if len(UnmaskingRequestHandler.U_5) >= t:
         logging.info("{} users have sent shares".format(len(UnmaskingRequestHandler.U_5)))
@@ -317,6 +285,13 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Secure aggregation protocol for federated learning")
     parser.add_argument("-u", "--user", type=int, default=10, help="the number of users")
     parser.add_argument("-t", "--wait", type=int, default=300, help="maximum waiting time for each round")
+    parser.add_argument("-k", "--keys", type=str, default="keys", help="the directory storing all users' keys")
+    parser.add_argument("--sig", type=str, default="rsa", choices=SIG.backends.keys(), help="the signature scheme")
+    parser.add_argument("--ka", type=str, default="dh", choices=KA.backends.keys(), help="the key agreement scheme")
+    parser.add_argument("--fanout", type=int, default=0,
+                        help="the fanout of the users relaying the broadcasts, 0 for the server sending to all users")
+    parser.add_argument("--mode", type=str, default="float", choices=["float", *FixedPoint.modes.keys()],
+                        help="the masking mode, i.e. masking floats or fixed-point integers in Z_{2^k}")
 
     args = parser.parse_args()
 
@@ -328,7 +303,9 @@ if __name__ == "__main__":
     wait_time = args.wait
     user_ids = [str(id) for id in range(1, args.user + 1)]
 
-    init(user_ids)
+    fixed_point = FixedPoint.from_mode(args.mode, args.user)
+
+    init(user_ids, args.keys, args.sig, args.ka, fixed_point, args.fanout)
 
     print("{:=^80s}".format("Finish Initializing"))
 
@@ -338,8 +315,6 @@ if __name__ == "__main__":
 
         sys.exit(1)
 
-    time.sleep(1)
-
     print("{:=^80s}".format("Finish Advertising Keys"))
 
     logging.info("online users: " + ','.join(U_1))
@@ -350,8 +325,6 @@ if __name__ == "__main__":
 
         sys.exit(1)
 
-    time.sleep(1)
-
     print("{:=^80s}".format("Finish Sharing Keys"))
 
     user_gradients = {}
@@ -368,8 +341,6 @@ if __name__ == "__main__":
 
         sys.exit(1)
 
-    time.sleep(1)
-
     print("{:=^80s}".format("Finish Masking Input"))
 
     res = consistency_check()
@@ -392,7 +363,12 @@ if __name__ == "__main__":
 
     print("{:=^80s}".format("Finish Unmasking"))
 
-    assert ((np.sum(np.array(input_gradients), axis=0) - output) < np.full(shape, 1e-6)).all()
+    if fixed_point is None:
+        assert (np.abs(np.sum(np.array(input_gradients), axis=0) - output) < np.full(shape, 1e-6)).all()
+    else:
+        # each user's quantization error is at most half a step
+        tolerance = len(U_3) * 2.0 ** -fixed_point.frac_bits
+        assert (np.abs(np.sum(np.array(input_gradients), axis=0) - fixed_point.decode(output)) < tolerance).all()
 
     print("{:=^80s}".format("Finish Secure Aggregation"))
 